@@ -0,0 +1,168 @@
+import os
+import json
+import shutil
+import hashlib
+
+# version of the cached results, to be increased whenever a change of the cleaning alters its outputs
+CACHE_VERSION=1
+# size in bytes of the blocks read when hashing the content of the input files
+HASH_BLOCK_SIZE=1<<24
+
+def content_hash(path, cache_dir):
+    '''
+    sha1 digest of the content of a file, or of all the files of a directory with their relative paths. The digest
+    of each file is stored in cache_dir/hashes under a name identifying its path, size and modification time
+    (see cleaning.file_key), so that an unchanged file is only hashed once, while a moved or copied file with
+    the same content gets the same digest.
+    '''
+    from conf_reg.cleaning import file_key
+    if os.path.isdir(path):
+        sha=hashlib.sha1()
+        for dirpath, dirnames, filenames in sorted(os.walk(path)):
+            for filename in sorted(filenames):
+                file=os.path.join(dirpath, filename)
+                sha.update(('%s:%s\n' % (os.path.relpath(file, path), content_hash(file, cache_dir))).encode())
+        return sha.hexdigest()
+
+    hash_file=os.path.join(cache_dir, 'hashes', file_key(path))
+    if os.path.isfile(hash_file):
+        with open(hash_file) as f:
+            return f.read().strip()
+    sha=hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            sha.update(block)
+    digest=sha.hexdigest()
+    os.makedirs(os.path.dirname(hash_file), exist_ok=True)
+    tmp_file='%s.%s.tmp' % (hash_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        f.write(digest)
+    os.replace(tmp_file, hash_file)
+    return digest
+
+def canonical_params(params):
+    '''
+    Canonical JSON representation of a dictionary of parameters: the keys are sorted, and the numbers
+    are represented as floats, so that e.g. a TR of 1 and 1.0 give the same key.
+    '''
+    def canonical(value):
+        if isinstance(value, bool) or value is None or isinstance(value, str):
+            return value
+        if isinstance(value, (int, float)):
+            return float(value)
+        if isinstance(value, dict):
+            return {str(key):canonical(item) for key,item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [canonical(item) for item in value]
+        return str(value)
+    return json.dumps(canonical(params), sort_keys=True)
+
+def result_key(input_files, params, cache_dir):
+    '''
+    Key of a result in the cache, from the content of its input files (a dictionary {name: path}, with None
+    for the unused inputs) and its parameters. It doesn't depend on the location or names of the inputs,
+    nor on the output directory.
+    '''
+    hashes={name:(content_hash(path, cache_dir) if path is not None else None) for name,path in input_files.items()}
+    description=canonical_params({'version':CACHE_VERSION, 'inputs':hashes, 'params':params})
+    return hashlib.sha1(description.encode()).hexdigest()
+
+def copy_output(src, dst):
+    '''
+    Copies the file or directory tree src to dst, replacing an existing dst. The outputs are copied rather than
+    hard linked, since the cleaning overwrites its outputs in place, which would alter a linked cache entry.
+    '''
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        shutil.rmtree(dst)
+    elif os.path.lexists(dst):
+        os.remove(dst)
+    if os.path.isdir(src):
+        shutil.copytree(src, dst)
+    else:
+        shutil.copy2(src, dst)
+
+def tree_size(path):
+    '''
+    Total size in bytes of a file or of the files of a directory tree.
+    '''
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(dirpath, filename)) for dirpath, dirnames, filenames in os.walk(path) for filename in filenames)
+
+def fetch_result(cache_dir, key, destinations):
+    '''
+    Restores the outputs of a cached result to destinations, a dictionary {output name: path}, and marks the
+    result as recently used. Returns the dictionary of the restored paths, with None for the outputs
+    which were not produced, or None if the key is not in the cache.
+    '''
+    entry=os.path.join(cache_dir, 'results', key)
+    try:
+        with open(os.path.join(entry, 'manifest.json')) as f:
+            manifest=json.load(f)
+        os.utime(entry)
+        restored={}
+        for name,destination in destinations.items():
+            if manifest['outputs'].get(name) is None or destination is None:
+                restored[name]=None
+                continue
+            copy_output(os.path.join(entry, manifest['outputs'][name]), destination)
+            restored[name]=destination
+    except FileNotFoundError:
+        #not in the cache, or evicted while being restored
+        return None
+    print('Restored the cached result %s.' % (key))
+    return restored
+
+def store_result(cache_dir, key, outputs, cache_size):
+    '''
+    Stores the outputs of a result, a dictionary {output name: file or directory} with None for the outputs which
+    were not produced, under its key. The least recently used results are then evicted to keep the cache
+    within cache_size (in GB).
+    '''
+    import tempfile
+    results_dir=os.path.join(cache_dir, 'results')
+    os.makedirs(results_dir, exist_ok=True)
+    entry=os.path.join(results_dir, key)
+    if os.path.isdir(entry):
+        return
+    #the result is assembled in a temporary directory, so that a concurrent run never reads a partial entry
+    tmp_entry=tempfile.mkdtemp(prefix='.%s.' % (key), dir=results_dir)
+    manifest={'outputs':{}}
+    for name,path in outputs.items():
+        if path is None:
+            manifest['outputs'][name]=None
+            continue
+        manifest['outputs'][name]=name
+        copy_output(path, os.path.join(tmp_entry, name))
+    manifest['size']=tree_size(tmp_entry)
+    with open(os.path.join(tmp_entry, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        #stored meanwhile by a concurrent run
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+    evict_results(cache_dir, cache_size*1e9)
+
+def evict_results(cache_dir, max_bytes):
+    '''
+    Removes the least recently used results from the cache until they total at most max_bytes.
+    '''
+    results_dir=os.path.join(cache_dir, 'results')
+    entries=[]
+    for key in os.listdir(results_dir):
+        if key.startswith('.'):
+            continue
+        entry=os.path.join(results_dir, key)
+        try:
+            with open(os.path.join(entry, 'manifest.json')) as f:
+                size=json.load(f)['size']
+            entries.append((os.stat(entry).st_mtime, size, entry))
+        except (FileNotFoundError, ValueError):
+            continue
+    total=sum(entry[1] for entry in entries)
+    for _,size,entry in sorted(entries):
+        if total<=max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total-=size
@@ -0,0 +1,816 @@
+import functools
+import numpy as np
+import nibabel as nb
+
+# number of distinct (n_timepoints, TR, band) settings whose filter and trend bases are kept in memory
+CACHE_SIZE=32
+# width of the raised-cosine transition of the tapered FFT filter, relative to each cutoff frequency
+TAPER_WIDTH=0.2
+FILTER_TYPES=('butterworth', 'fft_ideal', 'fft_tapered')
+# number of voxels upcast to float64 at once for the Butterworth filtering of float32 timeseries
+IIR_BLOCK_SIZE=4096
+# maximal deviation of float32 cleaning from the float64 path, relative to the standard deviation of the
+# float64 result, which is accepted by precision_check(). Float32 has a resolution of about 1e-7, and
+# the errors accumulated over the projections and the filter of a few thousand frames stay well below this.
+FLOAT32_TOLERANCE=1e-4
+# distance in bytes of uncompressed data between the seek points of the persistent gzip indices
+GZIP_INDEX_SPACING=4*1024**2
+# size in bytes of the blocks compressed in parallel as separate gzip members
+GZIP_BLOCK_SIZE=16*1024**2
+# number of standard deviations covered by the Gaussian smoothing kernel, as in scipy.ndimage and nilearn
+SMOOTHING_TRUNCATE=4.0
+
+def load_mask(mask_file):
+    '''
+    Loads a mask image as a boolean array.
+    '''
+    return np.asarray(nb.load(mask_file).dataobj)>0
+
+def file_key(filename):
+    '''
+    Name identifying the content of filename for the files derived from it (gzip indices, scratch copies).
+    It includes a hash of the path, size and modification time of the file, so that a derived file is
+    never reused for a modified file.
+    '''
+    import os
+    import hashlib
+    stat=os.stat(filename)
+    key=hashlib.sha1(('%s:%s:%s' % (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)).encode()).hexdigest()
+    return '%s_%s' % (os.path.basename(filename).split('.')[0], key[:16])
+
+def gzip_index_file(filename, index_dir):
+    '''
+    Path of the persistent seek-point index of the gzipped filename within index_dir.
+    '''
+    import os
+    return os.path.join(index_dir, file_key(filename)+'.gzidx')
+
+def evict_scratch(scratch_dir, max_bytes):
+    '''
+    Removes the least recently used uncompressed copies from scratch_dir until they total at most max_bytes.
+    '''
+    import os
+    entries=[]
+    for name in os.listdir(scratch_dir):
+        if name.endswith('.nii'):
+            try:
+                stat=os.stat(os.path.join(scratch_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+    total=sum(entry[1] for entry in entries)
+    for _,size,name in sorted(entries):
+        if total<=max_bytes:
+            break
+        try:
+            #images already opened by other stages remain readable after removal
+            os.remove(os.path.join(scratch_dir, name))
+        except FileNotFoundError:
+            pass
+        total-=size
+
+def scratch_copy(filename, scratch_dir, scratch_budget):
+    '''
+    Returns an uncompressed copy of the gzipped NIfTI filename within scratch_dir (e.g. on /dev/shm or a
+    local SSD), which is decompressed only on first use and can then be memory-mapped by every stage
+    reading the image. The copies are shared by all nodes and runs using scratch_dir, and kept within
+    scratch_budget (in GB) by evicting the least recently used ones. Returns filename itself if it is not
+    compressed or does not fit in the budget.
+    '''
+    import os
+    import gzip
+    import shutil
+    if not filename.endswith('.gz'):
+        return filename
+    os.makedirs(scratch_dir, exist_ok=True)
+    cached=os.path.join(scratch_dir, file_key(filename)+'.nii')
+    if os.path.isfile(cached):
+        os.utime(cached)
+        return cached
+    header=nb.load(filename).header
+    size=int(header.get_data_offset())+int(np.prod(header.get_data_shape()))*header.get_data_dtype().itemsize
+    if size>scratch_budget*1e9:
+        print('%s does not fit in the scratch budget, it is read from its original location.' % (filename))
+        return filename
+    evict_scratch(scratch_dir, scratch_budget*1e9-size)
+    tmp_file='%s.%s.tmp' % (cached, os.getpid())
+    with gzip.open(filename, 'rb') as f_in, open(tmp_file, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, 1<<24)
+    os.replace(tmp_file, cached)
+    return cached
+
+def load_image(filename, index_dir=None, scratch_dir=None, scratch_budget=10):
+    '''
+    Loads a NIfTI image lazily. When scratch_dir is provided, a gzipped image is read from its memory-mapped
+    uncompressed copy from scratch_copy(). Otherwise, when index_dir is provided and the image is gzipped,
+    its data is read through indexed_gzip with a seek-point index persisted in index_dir: the first load
+    builds the index in a single pass over the file, and later reads of any frame range or slab only inflate
+    the data from the nearest seek point. Falls back on nibabel.load if indexed_gzip is not installed.
+    '''
+    import os
+    if scratch_dir is not None:
+        filename=scratch_copy(filename, scratch_dir, scratch_budget)
+        if not filename.endswith('.gz'):
+            #the file is kept open, so that an eviction by another stage does not affect the loaded image
+            return nb.load(filename, mmap=True, keep_file_open=True)
+    if index_dir is None or not filename.endswith('.gz'):
+        return nb.load(filename, keep_file_open=True)
+    try:
+        import indexed_gzip
+    except ImportError:
+        print('indexed_gzip is not installed, the gzip index is not used for %s.' % (filename))
+        return nb.load(filename, keep_file_open=True)
+    os.makedirs(index_dir, exist_ok=True)
+    index_file=gzip_index_file(filename, index_dir)
+    if os.path.isfile(index_file):
+        fileobj=indexed_gzip.IndexedGzipFile(filename, spacing=GZIP_INDEX_SPACING, index_file=index_file)
+    else:
+        fileobj=indexed_gzip.IndexedGzipFile(filename, spacing=GZIP_INDEX_SPACING)
+        fileobj.build_full_index()
+        #written atomically, since scans can be loaded by concurrent nodes
+        tmp_file='%s.%s.tmp' % (index_file, os.getpid())
+        fileobj.export_index(tmp_file)
+        os.replace(tmp_file, index_file)
+    file_holder=nb.FileHolder(filename=filename, fileobj=fileobj)
+    return nb.Nifti1Image.from_file_map({'header':file_holder, 'image':file_holder})
+
+def mask_timeseries(array, mask):
+    '''
+    Extracts the in-mask voxels of a 4D array as a single time x voxel array. The timeseries
+    of each voxel are contiguous in memory, which is the layout used by all the cleaning steps.
+    '''
+    return array[mask].T
+
+def unmask_timeseries(data, mask):
+    '''
+    Scatters a time x voxel array back into a 4D array, with zeros outside the mask.
+    '''
+    array=np.zeros(mask.shape+(data.shape[0],), dtype=data.dtype)
+    array[mask]=data.T
+    return array
+
+def timeseries_to_img(data, mask, ref_img):
+    '''
+    Creates the 4D image of a time x voxel array, with the affine and header of ref_img.
+    '''
+    header=ref_img.header.copy()
+    header.set_data_dtype(data.dtype)
+    return nb.Nifti1Image(unmask_timeseries(data, mask), ref_img.affine, header)
+
+def read_only(array):
+    '''
+    Marks a cached array as read-only, so that it cannot be modified in place by a caller.
+    '''
+    array.setflags(write=False)
+    return array
+
+def detrend_timeseries(data):
+    '''
+    Removes the mean and linear trend of each column of a time x voxel array, in place.
+    '''
+    return project_out(data, trend_basis(data.shape[0]))
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def butterworth_sos(TR, low_pass=None, high_pass=None, order=5):
+    '''
+    Second-order sections of the Butterworth filter applied for the given cutoffs (in Hz),
+    with the same conventions as nilearn.signal.butterworth. Returns None if no filtering applies.
+    The result is cached, since scans of a dataset usually share the same settings; it is not marked
+    read-only because scipy's sosfilt requires a writable buffer, and is never modified in place.
+    '''
+    from scipy import signal
+    if low_pass is None and high_pass is None:
+        return None
+    if low_pass is not None and high_pass is not None and high_pass>=low_pass:
+        raise ValueError('High pass cutoff frequency (%s) is greater than or equal to low pass filter frequency (%s).' % (high_pass, low_pass))
+    nyq=0.5/TR
+    eps=np.finfo(np.float32).eps
+    critical_freq=[]
+    btypes=[]
+    for btype,freq in [('high',high_pass),('low',low_pass)]:
+        if freq is None:
+            continue
+        if freq>=nyq:
+            freq=nyq-(nyq*10*eps)
+            print('The %s pass frequency is higher than the Nyquist frequency, it has been lowered to %s.' % (btype, freq))
+        critical_freq.append(freq)
+        btypes.append(btype)
+    if len(critical_freq)==2:
+        if critical_freq[0]==critical_freq[1]:
+            print('The band-pass critical frequencies are equal, no filtering is applied.')
+            return None
+        btype='band'
+    else:
+        critical_freq=critical_freq[0]
+        btype=btypes[0]
+    return signal.butter(N=order, Wn=np.asarray(critical_freq)/nyq, btype=btype, output='sos')
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def fft_response(n_timepoints, TR, low_pass=None, high_pass=None, taper=False):
+    '''
+    Gain of the frequency-domain band-pass filter at the rfft frequencies of n_timepoints frames.
+    The ideal response is a brick-wall keeping the frequencies within the band, which makes the
+    filter an orthogonal projection. With taper, the gain instead follows a raised cosine over
+    TAPER_WIDTH times each cutoff, which limits ringing. Returns None if no filtering applies.
+    The result is cached and read-only.
+    '''
+    from scipy import fft
+    if low_pass is None and high_pass is None:
+        return None
+    if low_pass is not None and high_pass is not None and high_pass>=low_pass:
+        raise ValueError('High pass cutoff frequency (%s) is greater than or equal to low pass filter frequency (%s).' % (high_pass, low_pass))
+    freqs=fft.rfftfreq(n_timepoints, d=TR)
+    response=np.ones(freqs.shape, dtype=np.float64)
+    for btype,freq in [('high',high_pass),('low',low_pass)]:
+        if freq is None:
+            continue
+        if taper:
+            lower,upper=freq*(1-TAPER_WIDTH/2),freq*(1+TAPER_WIDTH/2)
+            ramp=0.5-0.5*np.cos(np.pi*np.clip((freqs-lower)/(upper-lower), 0, 1))
+        else:
+            ramp=(freqs>=freq).astype(np.float64) if btype=='high' else (freqs>freq).astype(np.float64)
+        response*=ramp if btype=='high' else 1-ramp
+    return read_only(response)
+
+def fft_filter(data, response, n_threads=1):
+    '''
+    Filters each column of a time x voxel array with a real FFT over the whole block, scaling the
+    spectrum by the response from fft_response(). The FFT plans are cached by scipy.fft across calls.
+    '''
+    from scipy import fft
+    spectrum=fft.rfft(data, axis=0, workers=n_threads)
+    spectrum*=response[:,np.newaxis]
+    return fft.irfft(spectrum, n=data.shape[0], axis=0, workers=n_threads)
+
+def standardize_timeseries(data):
+    '''
+    Z-scores each column of a time x voxel array in place (with the population standard deviation).
+    '''
+    data-=data.mean(axis=0)
+    std=data.std(axis=0)
+    std[std<np.finfo(np.float64).eps]=1.
+    data/=std
+    return data
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def trend_basis(n_timepoints):
+    '''
+    Orthonormal basis (time x 2) of the constant and linear trend regressors. The result is cached
+    and read-only.
+    '''
+    basis=np.ones((n_timepoints,2), dtype=np.float64)
+    basis[:,1]=np.arange(n_timepoints)
+    basis[:,1]-=basis[:,1].mean()
+    norms=np.sqrt((basis**2).sum(axis=0))
+    if norms[1]>np.finfo(np.float64).eps:
+        basis/=norms
+        return read_only(basis)
+    return read_only(basis[:,:1]/norms[0])
+
+def project_out(data, basis):
+    '''
+    Removes from a time x voxel array, in place, its projection onto the orthonormal columns of basis.
+    Both products are matrix-matrix (BLAS-3) operations over the whole block, in the precision of data.
+    '''
+    basis=basis.astype(data.dtype, copy=False)
+    data-=np.dot(basis, np.dot(basis.T, data))
+    return data
+
+class CleaningDesign(object):
+    '''
+    Temporal cleaning shared by all voxels of a scan: linear detrending, temporal filtering,
+    regression of the confounds orthogonally to the temporal filter (Lindquist 2018) and
+    standardization, with the same results as nilearn.signal.clean for the Butterworth filter.
+
+    The filtered design is built and factorized with a single QR decomposition. Since the
+    processed confounds are orthogonal to the trend regressors, and the mean is removed anyway
+    by standardization, the detrending, the regression and the demeaning reduce to projections
+    which are merged whenever no filter sits between them: without temporal filtering, apply()
+    takes a single projection and a sum of squares over the data; with filtering, one projection
+    before and one after the filter.
+
+    The steps of apply() are also available separately, so that a sweep of several designs over the same
+    data only takes the shared steps once (see sweep_apply()): prepare() (demeaning, detrending and filtering,
+    identical for designs with the same filter_key), residualize() (frame censoring and regression) and
+    standardize_block(). extend() builds a design regressing additional confounds, whose residuals are
+    obtained from those of the design it extends.
+
+    filter_type selects the temporal filter: 'butterworth' (forward-backward IIR filtering, as in
+    nilearn), or the frequency-domain 'fft_ideal' and 'fft_tapered' responses (see fft_response()),
+    computed with n_threads FFT workers. The confounds always go through the same filter as the data.
+
+    dtype sets the precision in which the timeseries are cleaned (float64 or float32). The design
+    itself is always built and factorized in float64, and only cast to dtype when applied.
+
+    frame_mask is an optional boolean array of the frames to keep (e.g. from scrubbing). The temporal
+    filter, and the detrending preceding it, require a continuous timeseries and are applied on all
+    frames. The censored frames are then dropped from the voxel matrix, and the remaining regression
+    is fitted on the kept frames only, before standardization. apply() only returns the kept frames.
+    '''
+    def __init__(self, n_timepoints, TR, confounds=None, low_pass=None, high_pass=None, detrend=True, standardize=True, filter_type='butterworth', n_threads=1, dtype=np.float64, frame_mask=None):
+        from scipy import linalg
+        if filter_type not in FILTER_TYPES:
+            raise ValueError('Unknown filter type %s, should be one of %s.' % (filter_type, ', '.join(FILTER_TYPES)))
+        self.n_timepoints=n_timepoints
+        self.filter_key=(n_timepoints, TR, low_pass, high_pass, filter_type, detrend, standardize, np.dtype(dtype).name)
+        self.parent=None
+        self.extra_basis=None
+        self.detrend=detrend
+        self.standardize=standardize
+        self.n_threads=n_threads
+        self.dtype=np.dtype(dtype)
+        self.frame_mask=None
+        self.n_frames=n_timepoints
+        if frame_mask is not None:
+            self.frame_mask=np.asarray(frame_mask, dtype=bool).reshape(n_timepoints)
+            self.n_frames=int(self.frame_mask.sum())
+            if self.n_frames==0:
+                raise ValueError('All %s frames are censored.' % (n_timepoints))
+        self.sos=None
+        self.response=None
+        if filter_type=='butterworth':
+            self.sos=butterworth_sos(TR, low_pass=low_pass, high_pass=high_pass)
+        else:
+            self.response=fft_response(n_timepoints, TR, low_pass=low_pass, high_pass=high_pass, taper=filter_type=='fft_tapered')
+        self.filtered=self.sos is not None or self.response is not None
+        trends=trend_basis(n_timepoints)
+        if not detrend:
+            trends=trends[:,:0]
+        # the regressors fitted after filtering are restricted to the kept frames
+        keep=slice(None) if self.frame_mask is None else self.frame_mask
+        columns=[]
+        if confounds is not None:
+            confounds=np.array(confounds, dtype=np.float64).reshape(n_timepoints, -1)
+            if detrend:
+                confounds=project_out(confounds, trends)
+            if self.filtered:
+                confounds=self.filter_timeseries(confounds)
+            columns.append(standardize_timeseries(confounds[keep,:]))
+        if standardize and (self.filtered or not detrend):
+            # the constant regressor is orthogonal to the standardized confounds, so that
+            # projecting it out with them is the demeaning step of the standardization
+            columns.append(np.ones((self.n_frames,1)))
+        # trend regressors are projected out before filtering, or together with the confounds
+        self.pre_basis=trends if self.filtered else None
+        if not self.filtered:
+            columns.insert(0, trends[keep,:])
+        self.post_basis=None
+        if len(columns)>0:
+            design=np.hstack(columns)
+            if design.shape[1]>0:
+                Q,R,_=linalg.qr(design, mode='economic', pivoting=True)
+                self.post_basis=Q[:,np.abs(np.diag(R))>np.finfo(np.float64).eps*100.]
+        if self.pre_basis is not None and self.pre_basis.shape[1]==0:
+            self.pre_basis=None
+
+    def filter_timeseries(self, data):
+        '''
+        Applies the temporal filter to each column of a time x voxel array, in the precision of data.
+        The recursive Butterworth filter is however always run in float64, by blocks of IIR_BLOCK_SIZE
+        voxels, since its poles close to the unit circle make it unstable in single precision.
+        '''
+        from scipy import signal
+        if self.sos is None:
+            return fft_filter(data, self.response, n_threads=self.n_threads)
+        if data.dtype==np.float64:
+            return signal.sosfiltfilt(self.sos, data, axis=0)
+        filtered=np.empty_like(data)
+        for start in range(0, data.shape[1], IIR_BLOCK_SIZE):
+            filtered[:,start:start+IIR_BLOCK_SIZE]=signal.sosfiltfilt(self.sos, data[:,start:start+IIR_BLOCK_SIZE].astype(np.float64), axis=0)
+        return filtered
+
+    def extend(self, confounds):
+        '''
+        Design regressing the additional confounds (time x confound, or None) on top of those of this design,
+        with the same filter and frame mask. The additional confounds are processed as in __init__, and only their
+        component orthogonal to the basis of this design is factorized, into extra_basis: the residuals of the
+        extended design are the residuals of this design with extra_basis projected out.
+        '''
+        import copy
+        from scipy import linalg
+        design=copy.copy(self)
+        design.parent=self
+        design.extra_basis=None
+        if confounds is None or np.size(confounds)==0:
+            return design
+        confounds=np.array(confounds, dtype=np.float64).reshape(self.n_timepoints, -1)
+        if self.detrend:
+            confounds=project_out(confounds, trend_basis(self.n_timepoints))
+        if self.filtered:
+            confounds=self.filter_timeseries(confounds)
+        keep=slice(None) if self.frame_mask is None else self.frame_mask
+        confounds=standardize_timeseries(confounds[keep,:])
+        if self.post_basis is not None:
+            project_out(confounds, self.post_basis)
+        Q,R,_=linalg.qr(confounds, mode='economic', pivoting=True)
+        extra_basis=Q[:,np.abs(np.diag(R))>np.finfo(np.float64).eps*100.]
+        if extra_basis.shape[1]>0:
+            design.extra_basis=extra_basis
+            design.post_basis=extra_basis if self.post_basis is None else np.hstack([self.post_basis, extra_basis])
+        return design
+
+    def prepare(self, data, dtype=None):
+        '''
+        Demeans, detrends and filters a time x voxel block (all frames), and returns a new array in the precision
+        of the design, or in the given dtype.
+        '''
+        data=np.array(data, dtype=self.dtype if dtype is None else dtype)
+        if data.dtype!=np.float64 and (self.detrend or self.standardize):
+            # the mean is removed by the cleaning anyway; removing it first, with float64 accumulation,
+            # keeps the single precision operations at the scale of the fluctuations rather than of the baseline
+            data-=data.mean(axis=0, dtype=np.float64).astype(data.dtype)
+        if self.pre_basis is not None:
+            project_out(data, self.pre_basis)
+        if self.filtered:
+            data=self.filter_timeseries(data)
+        return data
+
+    def residualize(self, data, copy=False):
+        '''
+        Drops the censored frames of a prepared block, and projects out the regressors, in place unless copy
+        is set (the frame censoring always copies).
+        '''
+        if self.frame_mask is not None:
+            data=data[self.frame_mask,:]
+        elif copy:
+            data=data.copy()
+        if self.post_basis is not None:
+            project_out(data, self.post_basis)
+        return data
+
+    def standardize_block(self, data):
+        '''
+        Scales each column of a residualized block to unit variance in place, if the design standardizes.
+        '''
+        if self.standardize:
+            std=np.sqrt(np.einsum('ij,ij->j', data, data, dtype=np.float64)/data.shape[0])
+            std[std<np.finfo(data.dtype).eps]=1.
+            data/=std.astype(data.dtype)
+        return data
+
+    def apply(self, data, dtype=None):
+        '''
+        Cleans a time x voxel block, and returns the cleaned block in the precision of the design,
+        or in the given dtype.
+        '''
+        return self.standardize_block(self.residualize(self.prepare(data, dtype=dtype)))
+
+def sweep_apply(designs, data):
+    '''
+    Cleans a time x voxel block with each of designs, and yields the cleaned blocks in order. The steps shared
+    between designs are taken once: the demeaning, detrending and filtering by the designs with the same
+    filter_key, and the regression of the confounds of a design by the designs extending it (see
+    CleaningDesign.extend()), which must follow it in designs. The intermediate arrays are released as soon
+    as no remaining design needs them.
+    '''
+    import collections
+    filter_uses=collections.Counter(design.filter_key for design in designs if design.parent is None or design.parent not in designs)
+    child_uses=collections.Counter(id(design.parent) for design in designs if design.parent is not None and design.parent in designs)
+    prepared={}
+    residuals={}
+    for design in designs:
+        if design.parent is not None and id(design.parent) in residuals:
+            parent=id(design.parent)
+            child_uses[parent]-=1
+            residual=residuals[parent] if child_uses[parent]==0 else residuals[parent].copy()
+            if child_uses[parent]==0:
+                del residuals[parent]
+            if design.extra_basis is not None:
+                project_out(residual, design.extra_basis)
+        else:
+            key=design.filter_key
+            if key not in prepared:
+                prepared[key]=design.prepare(data)
+            filter_uses[key]-=1
+            residual=design.residualize(prepared[key], copy=filter_uses[key]>0)
+            if filter_uses[key]==0:
+                del prepared[key]
+        if child_uses[id(design)]>0:
+            residuals[id(design)]=residual
+            residual=residual.copy()
+        yield design.standardize_block(residual)
+
+def batch_apply(designs, data):
+    '''
+    Cleans the time x (K*V) array data stacking the time x voxel arrays of K scans side by side, the columns of
+    scan k being cleaned with designs[k], and returns the list of the K cleaned arrays (views of a single array).
+    The designs must share their filter_key: the demeaning, detrending and filtering are applied to all the
+    columns at once. When the designs keep the same frames, the regression of the confounds of each scan is batched
+    as products of the K x frame x regressor tensor of their bases (zero-padded to the same number of regressors)
+    with the K x frame x V tensor of the data, and the standardization is applied to all the columns at once.
+    '''
+    n_scans=len(designs)
+    n_voxels=data.shape[1]//n_scans
+    if len(set(design.filter_key for design in designs))>1:
+        raise ValueError('The designs of a batch should share the same number of frames, TR, filter and precision.')
+    prepared=designs[0].prepare(data)
+    frame_masks=[design.frame_mask for design in designs]
+    if not all(frame_mask is None for frame_mask in frame_masks) and not all(frame_mask is not None and np.array_equal(frame_mask, frame_masks[0]) for frame_mask in frame_masks):
+        return [design.standardize_block(design.residualize(prepared[:,k*n_voxels:(k+1)*n_voxels])) for k,design in enumerate(designs)]
+    if frame_masks[0] is not None:
+        prepared=prepared[frame_masks[0],:]
+    # the tensor of the scans is a view of the columns, which requires a row-major array
+    prepared=np.ascontiguousarray(prepared)
+    n_frames=prepared.shape[0]
+    n_regressors=max([0]+[design.post_basis.shape[1] for design in designs if design.post_basis is not None])
+    if n_regressors>0:
+        bases=np.zeros((n_scans, n_frames, n_regressors), dtype=prepared.dtype)
+        for k,design in enumerate(designs):
+            if design.post_basis is not None:
+                bases[k,:,:design.post_basis.shape[1]]=design.post_basis
+        stacked=prepared.reshape(n_frames, n_scans, n_voxels).transpose(1,0,2)
+        stacked-=np.matmul(bases, np.matmul(bases.transpose(0,2,1), stacked))
+    cleaned=designs[0].standardize_block(prepared)
+    return [cleaned[:,k*n_voxels:(k+1)*n_voxels] for k in range(n_scans)]
+
+def precision_check(data, design, n_voxels=1000, seed=0):
+    '''
+    Cleans a random sample of n_voxels columns of the time x voxel array data both with design and in
+    float64, and returns the maximal absolute difference relative to the standard deviation of the
+    float64 result. Values above FLOAT32_TOLERANCE indicate that the precision of the design is not
+    sufficient for this data.
+    '''
+    sample=np.sort(np.random.default_rng(seed).choice(data.shape[1], min(n_voxels, data.shape[1]), replace=False))
+    block=np.asarray(data[:,sample])
+    reference=design.apply(block, dtype=np.float64)
+    scale=reference.std()
+    if not scale>0:
+        return 0.
+    return float(np.abs(design.apply(block)-reference).max()/scale)
+
+def block_size(memory_budget, n_rows, itemsize=8, copies=6):
+    '''
+    Number of columns of n_rows elements that can be processed at once within memory_budget (in GB),
+    given the number of copies of a block held simultaneously.
+    '''
+    return max(1, int(memory_budget*1e9/(n_rows*itemsize*copies)))
+
+def nifti_memmap(filename, ref_img, shape, dtype):
+    '''
+    Creates an uncompressed NIfTI file of the given shape and dtype, with the affine and header of
+    ref_img, and returns a writable memory map of its data array. The image can then be filled
+    by blocks without ever being held in memory.
+    '''
+    header=ref_img.header.copy()
+    header.set_data_dtype(dtype)
+    header.set_data_shape(shape)
+    header.set_slope_inter(1,0)
+    header.set_qform(ref_img.affine)
+    header.set_sform(ref_img.affine)
+    header['vox_offset']=0
+    with open(filename, 'wb') as f:
+        header.write_to(f)
+        offset=int(header['vox_offset'])
+        f.truncate(offset+int(np.prod(shape))*np.dtype(dtype).itemsize)
+    return np.memmap(filename, dtype=dtype, mode='r+', offset=offset, shape=tuple(shape), order='F')
+
+def gzip_member(block, gzip_level):
+    '''
+    Compresses a block of bytes as a complete gzip member.
+    '''
+    import zlib
+    compressor=zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+    return compressor.compress(block)+compressor.flush()
+
+def compress_file(in_file, out_file, gzip_level=1, n_threads=1):
+    '''
+    Gzip-compresses in_file into out_file without loading it in memory, and removes in_file. With n_threads
+    above 1, blocks of GZIP_BLOCK_SIZE bytes are compressed in parallel as separate gzip members (zlib releases
+    the GIL), whose concatenation remains a standard gzip file readable by gunzip, nibabel or FSL.
+    '''
+    import os
+    import gzip
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor
+    if n_threads<=1:
+        with open(in_file, 'rb') as f_in, gzip.open(out_file, 'wb', compresslevel=gzip_level) as f_out:
+            shutil.copyfileobj(f_in, f_out, GZIP_BLOCK_SIZE)
+    else:
+        with open(in_file, 'rb') as f_in, open(out_file, 'wb') as f_out, ThreadPoolExecutor(n_threads) as executor:
+            while True:
+                #a bounded number of blocks is held in memory at once
+                blocks=[block for block in (f_in.read(GZIP_BLOCK_SIZE) for i in range(2*n_threads)) if len(block)>0]
+                if len(blocks)==0:
+                    break
+                for member in executor.map(gzip_member, blocks, [gzip_level]*len(blocks)):
+                    f_out.write(member)
+    os.remove(in_file)
+
+def finalize_image(in_file, out_file, gzip_level=1, n_threads=1, start=None):
+    '''
+    Moves the uncompressed image in_file to out_file, compressing it if out_file ends with .gz, and reports
+    the time since start (by default, the time taken here) and the compression ratio.
+    '''
+    import os
+    import time
+    import shutil
+    if start is None:
+        start=time.time()
+    size=os.path.getsize(in_file)
+    if out_file.endswith('.gz'):
+        compress_file(in_file, out_file, gzip_level=gzip_level, n_threads=n_threads)
+    else:
+        shutil.move(in_file, out_file)
+    print('Wrote %s in %.2fs (%.1f MB uncompressed, compression ratio %.2f).' % (out_file, time.time()-start, size/1e6, size/max(os.path.getsize(out_file),1)))
+
+def write_image(img, out_file, gzip_level=1, n_threads=1):
+    '''
+    Writes img to out_file, either uncompressed (.nii) or gzipped (.nii.gz) with the given compression level
+    and number of threads, and reports the write time and compression ratio.
+    '''
+    import os
+    import time
+    start=time.time()
+    tmp_file='%s.%s.tmp.nii' % (out_file.split('.nii')[0], os.getpid())
+    img.to_filename(tmp_file)
+    finalize_image(tmp_file, out_file, gzip_level=gzip_level, n_threads=n_threads, start=start)
+
+def output_file(prefix, output_format='nii.gz'):
+    '''
+    Name of an output image from its prefix, with the extension of the output format (nii or nii.gz).
+    '''
+    return '%s.%s' % (prefix, output_format)
+
+def smoothing_sigmas(affine, fwhm):
+    '''
+    Standard deviations, in voxels along each spatial axis, of the Gaussian kernel of the given FWHM (in mm).
+    '''
+    vox_size=np.sqrt(np.sum(affine[:3,:3]**2, axis=0))
+    return fwhm/(np.sqrt(8*np.log(2))*vox_size)
+
+def smoothing_box(mask, sigmas):
+    '''
+    Bounding box (a tuple of slices) of the mask extended by the support of the smoothing kernel, and clipped
+    to the field of view. Smoothing the box gives the same in-mask values as smoothing the whole field of view.
+    '''
+    coordinates=np.nonzero(mask)
+    box=[]
+    for axis,sigma in enumerate(sigmas):
+        margin=int(SMOOTHING_TRUNCATE*sigma+0.5) if sigma>0 else 0
+        box.append(slice(max(int(coordinates[axis].min())-margin, 0), min(int(coordinates[axis].max())+1+margin, mask.shape[axis])))
+    return tuple(box)
+
+def gaussian_passes(array, sigmas, n_threads=1):
+    '''
+    Smooths in place the spatial axes of a 3D or 4D array by separable 1D Gaussian passes over all frames
+    at once. With n_threads above 1, chunks of frames are smoothed in parallel (scipy.ndimage releases the GIL).
+    '''
+    from scipy.ndimage import gaussian_filter1d
+    def smooth(chunk):
+        for axis,sigma in enumerate(sigmas):
+            if sigma>0:
+                gaussian_filter1d(chunk, sigma, axis=axis, output=chunk, mode='reflect', truncate=SMOOTHING_TRUNCATE)
+    if array.ndim<4 or n_threads<=1 or array.shape[3]<2:
+        smooth(array)
+        return array
+    from concurrent.futures import ThreadPoolExecutor
+    bounds=np.linspace(0, array.shape[3], min(n_threads, array.shape[3])+1).astype(int)
+    with ThreadPoolExecutor(n_threads) as executor:
+        list(executor.map(smooth, [array[:,:,:,start:end] for start,end in zip(bounds[:-1], bounds[1:])]))
+    return array
+
+def smooth_box(frames, mask, sigmas, within_mask=False, n_threads=1, dtype=np.float64):
+    '''
+    Smooths the 4D frames of a box (cropped with smoothing_box()), given the mask cropped to the same box,
+    and returns them as a new array of dtype. Non-finite values are set to 0. With within_mask, only the
+    in-mask voxels contribute: the smoothed masked frames are normalized by the smoothed mask, and the
+    frames are zero outside the mask.
+    '''
+    smoothed=np.array(frames, dtype=dtype)
+    smoothed[~np.isfinite(smoothed)]=0
+    if not within_mask:
+        return gaussian_passes(smoothed, sigmas, n_threads=n_threads)
+    smoothed[~mask]=0
+    gaussian_passes(smoothed, sigmas, n_threads=n_threads)
+    weights=gaussian_passes(mask.astype(dtype), sigmas)
+    smoothed[mask]/=weights[mask][:,np.newaxis]
+    smoothed[~mask]=0
+    return smoothed
+
+def smooth_image(img, mask, fwhm, within_mask=False, n_threads=1, dtype=np.float64):
+    '''
+    Smooths a 4D image with a Gaussian kernel of the given FWHM (in mm), as nilearn.image.smooth_img does
+    within the mask, but only reading and smoothing the bounding box of the mask with the kernel support,
+    in dtype (the precision of the cleaning, see CleaningDesign). The image is zero outside the box.
+    '''
+    header=img.header.copy()
+    header.set_data_dtype(dtype)
+    if not fwhm:
+        return nb.Nifti1Image(np.asarray(img.dataobj, dtype=dtype), img.affine, header)
+    sigmas=smoothing_sigmas(img.affine, fwhm)
+    box=smoothing_box(mask, sigmas)
+    array=np.zeros(img.shape, dtype=dtype, order='F')
+    array[box]=smooth_box(img.dataobj[box], mask[box], sigmas, within_mask=within_mask, n_threads=n_threads, dtype=dtype)
+    return nb.Nifti1Image(array, img.affine, header)
+
+def smooth_to_timeseries(img, mask, smoothing_filter, n_frames, out_data, smoothed_array=None, interval=slice(None), within_mask=False, n_threads=1, dtype=np.float64):
+    '''
+    Smooths the frames of img within interval (a slice of the frames) by chunks of n_frames, and stores
+    the in-mask voxels in the time x voxel array out_data (which can be memory-mapped). Only the bounding
+    box of the mask with the kernel support is read from the image proxy and smoothed in dtype (see smooth_image()).
+    The smoothed frames are also stored in the 4D smoothed_array if provided, which must be zero outside the box.
+    '''
+    frames_range=range(img.shape[3])[interval]
+    sigmas=smoothing_sigmas(img.affine, smoothing_filter) if smoothing_filter else np.zeros(3)
+    box=smoothing_box(mask, sigmas)
+    box_mask=mask[box]
+    for start in range(0, len(frames_range), n_frames):
+        chunk=frames_range[start:start+n_frames]
+        frames=img.dataobj[box+(slice(chunk.start, chunk.stop, chunk.step),)]
+        smoothed=smooth_box(frames, box_mask, sigmas, within_mask=within_mask, n_threads=n_threads, dtype=dtype)
+        out_data[start:start+smoothed.shape[3],:]=mask_timeseries(smoothed, box_mask)
+        if smoothed_array is not None:
+            smoothed_array[box+(slice(start, start+smoothed.shape[3]),)]=smoothed
+
+def clean_blocks(data, mask, designs, n_voxels, out_arrays=None, denoise=None, out_timeseries=None):
+    '''
+    Cleans the time x voxel array data by blocks of n_voxels voxels with each of designs (see sweep_apply()),
+    and scatters the cleaned blocks (of design.n_frames frames) in the corresponding 4D array of out_arrays
+    and/or stores them in the time x voxel array of out_timeseries, which can all be memory-mapped (or None).
+    denoise(block) is applied to each block before cleaning if provided.
+    '''
+    coordinates=np.nonzero(mask)
+    if out_arrays is None:
+        out_arrays=[None]*len(designs)
+    if out_timeseries is None:
+        out_timeseries=[None]*len(designs)
+    for start in range(0, data.shape[1], n_voxels):
+        block=np.asarray(data[:,start:start+n_voxels])
+        if denoise is not None:
+            block=denoise(block)
+        block_coordinates=tuple(c[start:start+n_voxels] for c in coordinates)
+        for cleaned,out_array,timeseries in zip(sweep_apply(designs, block), out_arrays, out_timeseries):
+            if out_array is not None:
+                out_array[block_coordinates]=cleaned.T.astype(out_array.dtype)
+            if timeseries is not None:
+                timeseries[:,start:start+cleaned.shape[1]]=cleaned
+
+def create_masked_store(store_dir, mask, ref_img, n_frames, dtype, frame_mask=None):
+    '''
+    Creates a masked output store, a compact alternative to a 4D image holding only the in-mask voxels:
+    store_dir contains timeseries.npy, the time x voxel array of the in-mask voxels (in the order of
+    numpy.nonzero(mask), each voxel timeseries being contiguous), mask.nii.gz with the affine and header of
+    ref_img, frame_mask.npy for the frames kept from the input if provided, and meta.json. Returns a
+    writable memory map of the timeseries array, to be filled by the caller.
+    '''
+    import os
+    import json
+    os.makedirs(store_dir, exist_ok=True)
+    header=ref_img.header.copy()
+    header.set_data_dtype(np.uint8)
+    nb.Nifti1Image(mask.astype(np.uint8), ref_img.affine, header).to_filename(os.path.join(store_dir, 'mask.nii.gz'))
+    if frame_mask is not None:
+        np.save(os.path.join(store_dir, 'frame_mask.npy'), np.asarray(frame_mask, dtype=bool))
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+        json.dump({'n_frames':int(n_frames), 'n_voxels':int(mask.sum()), 'dtype':np.dtype(dtype).name,
+            'layout':'time x voxel, voxels in the order of numpy.nonzero(mask)'}, f, indent=4)
+    return np.lib.format.open_memmap(os.path.join(store_dir, 'timeseries.npy'), mode='w+', dtype=dtype, shape=(int(n_frames), int(mask.sum())), fortran_order=True)
+
+def write_masked_store(store_dir, data, mask, ref_img, frame_mask=None):
+    '''
+    Writes the time x voxel array data of the in-mask voxels as a masked output store (see create_masked_store()).
+    '''
+    timeseries=create_masked_store(store_dir, mask, ref_img, data.shape[0], data.dtype, frame_mask=frame_mask)
+    timeseries[:]=data
+    timeseries.flush()
+
+def load_masked_store(store_dir, mmap_mode='r'):
+    '''
+    Opens a masked output store, and returns a dictionary with the time x voxel array of the in-mask voxels
+    (memory-mapped without copy by default), the boolean mask, the mask image (with the affine and header)
+    and the frame mask (None if no frame was censored).
+    '''
+    import os
+    mask_img=nb.load(os.path.join(store_dir, 'mask.nii.gz'))
+    frame_mask_file=os.path.join(store_dir, 'frame_mask.npy')
+    return {'timeseries':np.load(os.path.join(store_dir, 'timeseries.npy'), mmap_mode=mmap_mode),
+        'mask':np.asarray(mask_img.dataobj)>0, 'mask_img':mask_img,
+        'frame_mask':np.load(frame_mask_file) if os.path.isfile(frame_mask_file) else None}
+
+def masked_store_to_img(store_dir):
+    '''
+    Reconstructs the 4D image of a masked output store, with zeros outside the mask.
+    '''
+    store=load_masked_store(store_dir)
+    return timeseries_to_img(np.asarray(store['timeseries']), store['mask'], store['mask_img'])
+
+def masked_store_to_file(store_dir, out_file, n_voxels=None, gzip_level=1, n_threads=1):
+    '''
+    Writes the 4D image of a masked output store to out_file, scattering the timeseries by blocks of n_voxels voxels
+    (all at once by default) into a memory-mapped uncompressed image, so that the memory use stays within a block.
+    '''
+    import os
+    import time
+    start=time.time()
+    store=load_masked_store(store_dir)
+    timeseries=store['timeseries']
+    if n_voxels is None:
+        n_voxels=max(timeseries.shape[1], 1)
+    tmp_file='%s.%s.tmp.nii' % (out_file.split('.nii')[0], os.getpid())
+    out_array=nifti_memmap(tmp_file, store['mask_img'], store['mask'].shape+(timeseries.shape[0],), timeseries.dtype)
+    coordinates=np.nonzero(store['mask'])
+    for first in range(0, timeseries.shape[1], n_voxels):
+        out_array[tuple(c[first:first+n_voxels] for c in coordinates)]=np.asarray(timeseries[:,first:first+n_voxels]).T
+    out_array.flush()
+    del out_array
+    finalize_image(tmp_file, out_file, gzip_level=gzip_level, n_threads=n_threads, start=start)
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 import os
 import sys
-from utils import regress,tree_list,get_info_list,find_scans, data_diagnosis, select_timeseries
+from utils import regress,scan_catalog,get_info_list,find_scans, data_diagnosis,load_sweep_spec,commonspace_batches,regress_batch
 import argparse
 
 """Build parser object"""
@@ -25,8 +25,17 @@ parser.add_argument('--highpass', type=float, default=None,
                     help='Specify highpass filter frequency.')
 parser.add_argument('--lowpass', type=float, default=None,
                     help='Specify lowpass filter frequency.')
+parser.add_argument('--filter_type', type=str, default='butterworth',
+                    choices=['butterworth', 'fft_ideal', 'fft_tapered'],
+                    help="""Temporal filter applied for --highpass/--lowpass. 'butterworth' applies a forward-backward
+                    Butterworth filter as in nilearn, while 'fft_ideal' and 'fft_tapered' apply a brick-wall or raised-cosine
+                    frequency response with real FFTs over all voxels at once. The confounds are filtered in the same way.""")
 parser.add_argument('--smoothing_filter', type=float, default=0.3,
                     help='Specify smoothing filter size in mm.')
+parser.add_argument('--smoothing_within_mask', dest='smoothing_within_mask', action='store_true', default=False,
+                    help="Smooth within the brain mask only, normalizing by the smoothed mask, so that out-of-brain signal "
+                         "does not leak into the edge voxels. The smoothing is otherwise applied as in nilearn, within the "
+                         "bounding box of the brain mask extended by the kernel support, in the precision set by --dtype.")
 parser.add_argument('--TR', type=float,
                     default=1.0,
                     help='Repetition time')
@@ -36,6 +45,14 @@ parser.add_argument('--run_aroma', dest='run_aroma', action='store_true',
 parser.add_argument('--aroma_dim', type=int,
                     default=0,
                     help='Can specify a number of dimension for MELODIC.')
+parser.add_argument('--aroma_seed', type=int,
+                    default=0,
+                    help='Seed of the random splits of the maximum RP correlation feature of ICA-AROMA, so that the '
+                         'classification of the motion components is reproducible.')
+parser.add_argument('--write_smoothed', dest='write_smoothed', action='store_true', default=False,
+                    help="Write the smoothed timeseries as output_dir/<scan>_smoothed (in --output_format). By default, the "
+                         "smoothed timeseries are kept in memory, and only handed to MELODIC through a temporary uncompressed "
+                         "file when running ICA-AROMA, whose denoising is applied to the in-memory timeseries.")
 parser.add_argument('--conf_list', type=str,
                     nargs="*",  # 0 or more values expected => creates a list
                     default=[],
@@ -44,13 +61,67 @@ parser.add_argument('--apply_scrubbing', dest='apply_scrubbing', action='store_t
                     default=False,
                     help="""Whether to apply scrubbing or not. A temporal mask will be generated based on the FD threshold.
                     The frames that exceed the given threshold together with 1 back and 2 forward frames will be masked out
-                    from the data after the application of all other confound regression steps (as in Power et al. 2012).""")
+                    from the data (as in Power et al. 2012). Temporal filtering (with the detrending preceding it) is applied on
+                    the complete timeseries, then the censored frames are excluded from the fit of the remaining regressors
+                    and from the standardization. The temporal mask is written with the cleaned timeseries.""")
 parser.add_argument('--scrubbing_threshold', type=float,
                     default=0.1,
                     help='Scrubbing threshold for the mean framewise displacement in mm? (averaged across the brain mask) to select corrupted volumes.')
+parser.add_argument("--sweep_spec", type=str, default=None,
+                    help="Optional JSON file listing variants of the cleaning to compare, e.g. "
+                         '[{"name": "mot_6", "conf_list": ["mot_6"]}, {"name": "mot_24_scrub", "conf_list": ["mot_24"], "apply_scrubbing": true}]. '
+                         "Each variant can change --conf_list, --lowpass, --highpass, --filter_type, --apply_scrubbing and "
+                         "--scrubbing_threshold, and its outputs are written in output_dir/<name>. Each scan is loaded, smoothed and "
+                         "denoised with ICA-AROMA once for all the variants, which are then fitted on the same voxel matrix, sharing "
+                         "the temporal filtering, and the regression of the confounds of a variant with the variants extending them.")
+parser.add_argument("--batch_commonspace", dest='batch_commonspace', action='store_true', default=False,
+                    help="With --commonspace_bold, clean together the scans sharing the same commonspace brain mask and number of "
+                         "frames, by batches sized to fit the --memory_budget (which is required). Each scan is smoothed and denoised "
+                         "with ICA-AROMA in turn, then the temporal filtering of the whole batch and the regression of the confounds of "
+                         "each scan are applied at once on the stacked voxel matrices of the batch. A scan which does not fit in a "
+                         "batch with another one is cleaned on its own, out-of-core. Not compatible with --sweep_spec and --result_cache.")
 parser.add_argument("-p", "--plugin", type=str, default='Linear',
                     help="Specify the nipype plugin for workflow execution. Consult nipype plugin documentation for detailed options."
                          " Linear, MultiProc, SGE and SGEGraph have been tested.")
+parser.add_argument("--memory_budget", type=float, default=None,
+                    help="Memory budget in GB for the cleaning of each scan. If provided, the scans are processed out-of-core, "
+                         "by chunks of frames and blocks of voxels sized to fit the budget, instead of being loaded entirely in memory.")
+parser.add_argument("--n_threads", type=int, default=1,
+                    help="Number of threads used within each scan for the multithreaded steps (FFT filtering and smoothing).")
+parser.add_argument("--dtype", type=str, default='float64', choices=['float64', 'float32'],
+                    help="Precision in which the timeseries are smoothed, cleaned and written. float32 halves the memory use and "
+                         "bandwidth, while the design matrices are still factorized in float64; the deviation from float64 "
+                         "cleaning is measured on a sample of voxels and reported for each scan.")
+parser.add_argument("--gzip_index", dest='gzip_index', action='store_true', default=False,
+                    help="Build a seek-point index of each gzipped input BOLD (with indexed_gzip), stored in output_dir/gzip_index "
+                         "and reused across runs, so that partial reads (a timeseries interval, chunks of frames) only inflate "
+                         "the data needed.")
+parser.add_argument("--scratch_dir", type=str, default=None,
+                    help="Optional local scratch directory (e.g. /dev/shm or a local SSD) where each gzipped input is decompressed "
+                         "once, into an uncompressed image memory-mapped by every stage reading it.")
+parser.add_argument("--scratch_budget", type=float, default=10,
+                    help="Maximal size in GB of the uncompressed images kept in --scratch_dir. The least recently used images "
+                         "are evicted to stay within the budget.")
+parser.add_argument("--output_format", type=str, default='nii.gz', choices=['nii.gz', 'nii'],
+                    help="Format of the output images (cleaned timeseries, smoothed timeseries and diagnosis maps). "
+                         "Uncompressed nii outputs are larger, but written and read much faster.")
+parser.add_argument("--gzip_level", type=int, default=1, choices=range(1,10), metavar='{1-9}',
+                    help="Compression level of the nii.gz outputs. With --n_threads above 1, blocks of the images are compressed "
+                         "in parallel as separate gzip members, which remain readable by standard tools.")
+parser.add_argument("--output_store", type=str, default='nifti', choices=['nifti', 'masked', 'both'],
+                    help="""How the cleaned timeseries are stored. 'nifti' writes a 4D image. 'masked' instead writes a compact store
+                    of the in-mask voxels, as a memory-mappable time x voxel array (timeseries.npy) with the brain mask, the
+                    frame mask and a meta.json, which conf_reg.cleaning.load_masked_store() opens without copy and
+                    conf_reg.cleaning.masked_store_to_img() converts back to a 4D image. 'both' writes the two.""")
+parser.add_argument("--result_cache", type=str, default=None,
+                    help="Optional directory of a result cache shared across runs. The outputs of the cleaning (including the "
+                         "ICA-AROMA outputs) and of the diagnosis of each scan are stored under a key made of the content hashes of "
+                         "their input files and of the parameters changing them, and a scan whose key is present is restored "
+                         "instead of being recomputed, whatever the output_dir, datasink location or order of --conf_list. "
+                         "The smoothing, ICA-AROMA and cleaning stages are also checkpointed under their own key, so that "
+                         "a run changing only downstream parameters (e.g. --conf_list or --output_format) reuses the upstream stages.")
+parser.add_argument("--result_cache_size", type=float, default=50,
+                    help="Maximal size in GB of the --result_cache. The least recently used results are evicted to stay within it.")
 parser.add_argument("--min_proc", type=int, default=1,
                     help="For parallel processing, specify the minimal number of nodes to be assigned.")
 parser.add_argument('--timeseries_interval', type=str, default='all',
@@ -74,9 +145,13 @@ commonspace_bold=args.commonspace_bold
 bold_only=args.bold_only
 lowpass=args.lowpass
 highpass=args.highpass
+filter_type=args.filter_type
 smoothing_filter=args.smoothing_filter
+smoothing_within_mask=args.smoothing_within_mask
+write_smoothed=args.write_smoothed
 run_aroma=args.run_aroma
 aroma_dim=args.aroma_dim
+aroma_seed=args.aroma_seed
 conf_list=args.conf_list
 TR=args.TR
 apply_scrubbing=args.apply_scrubbing
@@ -86,25 +161,38 @@ timeseries_interval=args.timeseries_interval
 diagnosis_output=args.diagnosis_output
 seed_list=args.seed_list
 min_proc=args.min_proc
+memory_budget=args.memory_budget
+n_threads=args.n_threads
+dtype=args.dtype
+gzip_index_dir=out_dir+'/gzip_index' if args.gzip_index else None
+scratch_dir=os.path.abspath(args.scratch_dir) if args.scratch_dir is not None else None
+scratch_budget=args.scratch_budget
+output_format=args.output_format
+gzip_level=args.gzip_level
+output_store=args.output_store
+result_cache=os.path.abspath(args.result_cache) if args.result_cache is not None else None
+result_cache_size=args.result_cache_size
+sweep=load_sweep_spec(args.sweep_spec) if args.sweep_spec is not None else None
+batch_commonspace=args.batch_commonspace
+if batch_commonspace and (not commonspace_bold or bold_only):
+    parser.error('--batch_commonspace requires --commonspace_bold, without --bold_only.')
+if batch_commonspace and memory_budget is None:
+    parser.error('--batch_commonspace requires a --memory_budget to size the batches.')
+if batch_commonspace and (sweep is not None or result_cache is not None):
+    parser.error('--batch_commonspace is not compatible with --sweep_spec and --result_cache.')
 
-if bold_only:
-    bold_files=tree_list(os.path.abspath(rabies_out)+'/bold_datasink/corrected_bold')
-    brain_mask_files=tree_list(os.path.abspath(rabies_out)+'/bold_datasink/bold_brain_mask')
-    csf_mask_files=tree_list(os.path.abspath(rabies_out)+'/bold_datasink/bold_CSF_mask')
+if bold_only or not commonspace_bold:
+    bold_datasinks={'bold':'corrected_bold', 'brain_mask':'bold_brain_mask', 'csf_mask':'bold_CSF_mask'}
 else:
-    if commonspace_bold:
-        bold_files=tree_list(os.path.abspath(rabies_out)+'/bold_datasink/commonspace_bold')
-        brain_mask_files=tree_list(os.path.abspath(rabies_out)+'/bold_datasink/commonspace_bold_mask')
-        csf_mask_files=tree_list(os.path.abspath(rabies_out)+'/bold_datasink/commonspace_bold_CSF_mask')
-    else:
-        bold_files=tree_list(os.path.abspath(rabies_out)+'/bold_datasink/corrected_bold')
-        brain_mask_files=tree_list(os.path.abspath(rabies_out)+'/bold_datasink/bold_brain_mask')
-        csf_mask_files=tree_list(os.path.abspath(rabies_out)+'/bold_datasink/bold_CSF_mask')
-
-confounds_files=tree_list(os.path.abspath(rabies_out)+'/confounds_datasink/confounds_csv')
-FD_files=tree_list(os.path.abspath(rabies_out)+'/confounds_datasink/FD_csv')
+    bold_datasinks={'bold':'commonspace_bold', 'brain_mask':'commonspace_bold_mask', 'csf_mask':'commonspace_bold_CSF_mask'}
+datasinks={kind:os.path.abspath(rabies_out)+'/bold_datasink/'+datasink for kind,datasink in bold_datasinks.items()}
+datasinks['confounds']=os.path.abspath(rabies_out)+'/confounds_datasink/confounds_csv'
+datasinks['FD']=os.path.abspath(rabies_out)+'/confounds_datasink/FD_csv'
 
-scan_list=get_info_list(bold_files)
+#the files are indexed once by scan, and the catalog is reused by later runs until the datasinks change
+os.makedirs(out_dir, exist_ok=True)
+catalog=scan_catalog(datasinks, catalog_file=out_dir+'/scan_catalog.json')
+scan_list=sorted(get_info_list(catalog['bold'].values()))
 
 
 #execute within a nipype workflow
@@ -112,26 +200,39 @@ from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu
 from nipype.interfaces.utility import Function
 
-info_node = pe.Node(niu.IdentityInterface(fields=['scan_info']),
-                  name="info_node", mem_gb=1)
-info_node.iterables = [('scan_info', scan_list)]
-
-
-find_scans_node = pe.Node(Function(input_names=['scan_info', 'bold_files', 'brain_mask_files', 'confounds_files', 'csf_mask_files', 'FD_files'],
-                          output_names=['bold_file', 'brain_mask_file', 'confounds_file', 'csf_mask', 'FD_file'],
-                          function=find_scans),
-                 name='find_scans', mem_gb=1)
-find_scans_node.inputs.bold_files = bold_files
-find_scans_node.inputs.brain_mask_files = brain_mask_files
-find_scans_node.inputs.csf_mask_files = csf_mask_files
-find_scans_node.inputs.confounds_files = confounds_files
-find_scans_node.inputs.FD_files = FD_files
-
-regress_node = pe.Node(Function(input_names=['scan_info','bold_file', 'brain_mask_file', 'confounds_file', 'csf_mask', 'FD_file', 'conf_list',
-                                             'TR', 'lowpass', 'highpass', 'smoothing_filter', 'run_aroma', 'aroma_dim', 'apply_scrubbing', 'scrubbing_threshold', 'timeseries_interval', 'out_dir'],
-                          output_names=['cleaned_path', 'bold_file', 'aroma_out'],
-                          function=regress),
-                 name='regress', mem_gb=1)
+# parameters of the cleaning, shared by regress() and regress_batch()
+regress_inputs=['conf_list', 'TR', 'lowpass', 'highpass', 'smoothing_filter', 'run_aroma', 'aroma_dim', 'apply_scrubbing', 'scrubbing_threshold', 'timeseries_interval', 'out_dir', 'memory_budget', 'filter_type', 'n_threads', 'dtype', 'gzip_index_dir', 'scratch_dir', 'scratch_budget', 'output_format', 'gzip_level', 'output_store', 'smoothing_within_mask', 'write_smoothed', 'result_cache', 'result_cache_size', 'sweep', 'aroma_seed']
+
+if batch_commonspace:
+    #the scans sharing the commonspace mask and number of frames are cleaned together, by batches fitting the memory budget
+    batches=commonspace_batches(scan_list, catalog, timeseries_interval, memory_budget, dtype)
+    print('Cleaning %s scans in %s batches.' % (len(scan_list), len(batches)))
+    info_node = pe.Node(niu.IdentityInterface(fields=['batch_index']),
+                      name="info_node", mem_gb=1)
+    info_node.iterables = [('batch_index', list(range(len(batches))))]
+
+    regress_node = pe.Node(Function(input_names=['batch_index', 'batches', 'catalog']+regress_inputs,
+                              output_names=['cleaned_path', 'bold_file', 'aroma_out', 'frame_mask_file', 'masked_store', 'brain_mask_file'],
+                              function=regress_batch),
+                     name='regress_batch', mem_gb=memory_budget, n_procs=n_threads)
+    regress_node.inputs.batches = batches
+    regress_node.inputs.catalog = catalog
+else:
+    info_node = pe.Node(niu.IdentityInterface(fields=['scan_info']),
+                      name="info_node", mem_gb=1)
+    info_node.iterables = [('scan_info', scan_list)]
+
+
+    find_scans_node = pe.Node(Function(input_names=['scan_info', 'catalog'],
+                              output_names=['bold_file', 'brain_mask_file', 'confounds_file', 'csf_mask', 'FD_file'],
+                              function=find_scans),
+                     name='find_scans', mem_gb=1)
+    find_scans_node.inputs.catalog = catalog
+
+    regress_node = pe.Node(Function(input_names=['scan_info','bold_file', 'brain_mask_file', 'confounds_file', 'csf_mask', 'FD_file']+regress_inputs,
+                              output_names=['cleaned_path', 'bold_file', 'aroma_out', 'frame_mask_file', 'masked_store'],
+                              function=regress),
+                     name='regress', mem_gb=1 if memory_budget is None else memory_budget, n_procs=n_threads)
 regress_node.inputs.conf_list = conf_list
 regress_node.inputs.TR = TR
 regress_node.inputs.lowpass = lowpass
@@ -139,59 +240,79 @@ regress_node.inputs.highpass = highpass
 regress_node.inputs.smoothing_filter = smoothing_filter
 regress_node.inputs.run_aroma = run_aroma
 regress_node.inputs.aroma_dim = aroma_dim
+regress_node.inputs.aroma_seed = aroma_seed
 regress_node.inputs.apply_scrubbing = apply_scrubbing
 regress_node.inputs.scrubbing_threshold = scrubbing_threshold
 regress_node.inputs.timeseries_interval = timeseries_interval
 regress_node.inputs.out_dir = out_dir
+regress_node.inputs.memory_budget = memory_budget
+regress_node.inputs.filter_type = filter_type
+regress_node.inputs.n_threads = n_threads
+regress_node.inputs.dtype = dtype
+regress_node.inputs.gzip_index_dir = gzip_index_dir
+regress_node.inputs.scratch_dir = scratch_dir
+regress_node.inputs.scratch_budget = scratch_budget
+regress_node.inputs.output_format = output_format
+regress_node.inputs.gzip_level = gzip_level
+regress_node.inputs.output_store = output_store
+regress_node.inputs.smoothing_within_mask = smoothing_within_mask
+regress_node.inputs.write_smoothed = write_smoothed
+regress_node.inputs.result_cache = result_cache
+regress_node.inputs.result_cache_size = result_cache_size
+regress_node.inputs.sweep = sweep
 
 workflow = pe.Workflow(name='confound_regression')
-workflow.connect([
-    (info_node, find_scans_node, [
-        ("scan_info", "scan_info"),
-        ]),
-    (info_node, regress_node, [
-        ("scan_info", "scan_info"),
-        ]),
-    (find_scans_node, regress_node, [
-        ("brain_mask_file", "brain_mask_file"),
-        ("confounds_file", "confounds_file"),
-        ("csf_mask", "csf_mask"),
-        ("FD_file", "FD_file"),
-        ]),
-    ])
-
-
-if not timeseries_interval=='all':
-    select_timeseries_node = pe.Node(Function(input_names=['bold_file', 'timeseries_interval'],
-                              output_names=['bold_file'],
-                              function=select_timeseries),
-                     name='select_timeseries', mem_gb=1)
-    select_timeseries_node.inputs.timeseries_interval = timeseries_interval
-
+if batch_commonspace:
     workflow.connect([
-        (find_scans_node, select_timeseries_node, [
-            ("bold_file", "bold_file"),
-            ]),
-        (select_timeseries_node, regress_node, [
-            ("bold_file", "bold_file"),
+        (info_node, regress_node, [
+            ("batch_index", "batch_index"),
             ]),
         ])
 else:
     workflow.connect([
+        (info_node, find_scans_node, [
+            ("scan_info", "scan_info"),
+            ]),
+        (info_node, regress_node, [
+            ("scan_info", "scan_info"),
+            ]),
         (find_scans_node, regress_node, [
             ("bold_file", "bold_file"),
+            ("brain_mask_file", "brain_mask_file"),
+            ("confounds_file", "confounds_file"),
+            ("csf_mask", "csf_mask"),
+            ("FD_file", "FD_file"),
             ]),
         ])
 
 
 if diagnosis_output:
-    data_diagnosis_node = pe.Node(Function(input_names=['bold_file', 'cleaned_path', 'brain_mask_file', 'seed_list'],
+    #with a sweep, the diagnosis is run on the cleaned timeseries of each variant, and with batches, of each scan
+    if batch_commonspace:
+        diagnosis_node_type = pe.MapNode
+        diagnosis_iterfield = {'iterfield':['cleaned_path', 'bold_file', 'brain_mask_file']}
+    elif sweep is not None:
+        diagnosis_node_type = pe.MapNode
+        diagnosis_iterfield = {'iterfield':['cleaned_path']}
+    else:
+        diagnosis_node_type = pe.Node
+        diagnosis_iterfield = {}
+    data_diagnosis_node = diagnosis_node_type(Function(input_names=['bold_file', 'cleaned_path', 'brain_mask_file', 'seed_list', 'timeseries_interval', 'gzip_index_dir', 'scratch_dir', 'scratch_budget', 'output_format', 'gzip_level', 'n_threads', 'result_cache', 'result_cache_size'],
                               output_names=['mel_out','tSNR_file','corr_map_list'],
                               function=data_diagnosis),
-                     name='data_diagnosis', mem_gb=1)
+                     name='data_diagnosis', mem_gb=1, **diagnosis_iterfield)
     data_diagnosis_node.inputs.seed_list=seed_list
+    data_diagnosis_node.inputs.timeseries_interval=timeseries_interval
+    data_diagnosis_node.inputs.gzip_index_dir=gzip_index_dir
+    data_diagnosis_node.inputs.scratch_dir=scratch_dir
+    data_diagnosis_node.inputs.scratch_budget=scratch_budget
+    data_diagnosis_node.inputs.output_format=output_format
+    data_diagnosis_node.inputs.gzip_level=gzip_level
+    data_diagnosis_node.inputs.n_threads=n_threads
+    data_diagnosis_node.inputs.result_cache=result_cache
+    data_diagnosis_node.inputs.result_cache_size=result_cache_size
     workflow.connect([
-        (find_scans_node, data_diagnosis_node, [
+        (regress_node if batch_commonspace else find_scans_node, data_diagnosis_node, [
             ("brain_mask_file", "brain_mask_file"),
             ]),
         (regress_node, data_diagnosis_node, [
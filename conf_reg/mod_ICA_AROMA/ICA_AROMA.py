@@ -12,11 +12,6 @@ import ICA_AROMA_functions as aromafunc
 import shutil
 import classification_plots
 
-# Change to script directory
-cwd = os.path.realpath(os.path.curdir)
-scriptDir = os.path.dirname(os.path.abspath(__file__))
-os.chdir(scriptDir)
-
 #-------------------------------------------- PARSER --------------------------------------------#
 
 parser = argparse.ArgumentParser(description='Script to run ICA-AROMA v0.3 beta (\'ICA-based Automatic Removal Of Motion Artifacts\') on fMRI data. See the companion manual for further information.')
@@ -29,7 +24,7 @@ reqoptions.add_argument('-o', '-out', dest="outDir", required=True, help='Output
 nonfeatoptions = parser.add_argument_group('Required arguments - generic mode')
 nonfeatoptions.add_argument('-i', '-in', dest="inFile", required=False, help='Input file name of fMRI data (.nii.gz)')
 nonfeatoptions.add_argument('-mc', dest="mc", required=False, help='File name of the motion parameters obtained after motion realingment (e.g., FSL mcflirt). Note that the order of parameters does not matter, should your file not originate from FSL mcflirt. (e.g., /home/user/PROJECT/SUBJECT.feat/mc/prefiltered_func_data_mcf.par')
-nonfeatoptions.add_argument('-m', '-mask', dest="mask", default="", help='File name of the mask to be used for MELODIC (denoising will be performed on the original/non-masked input data)')
+nonfeatoptions.add_argument('-m', '-mask', dest="mask", default="", help='File name of the mask to be used for MELODIC and the denoising (voxels outside the mask are left unchanged)')
 nonfeatoptions.add_argument('-c', '-mask_csf', dest="mask_csf", default="", help='')
 
 # Optional options
@@ -131,8 +126,7 @@ shutil.copyfile(args.mask, mask)
 #---------------------------------------- Run ICA-AROMA ----------------------------------------#
 
 print('Step 1) MELODIC')
-aromafunc.runICA(fslDir, inFile, outDir, melDir, mask, dim, TR)
-melIC = os.path.join(outDir, 'melodic_IC_thr.nii.gz')
+melIC = aromafunc.runICA(fslDir, inFile, outDir, melDir, mask, dim, TR)
 
 print('Step 2) Automatic classification of the components')
 
@@ -146,7 +140,7 @@ aromafunc.compute_out_mask(mask,mask_out)
 
 print('  - extracting the CSF & Edge fraction features')
 #modified inputs for the spatial features, by providing the required masks manually
-edgeFract, csfFract = aromafunc.mod_feature_spatial(fslDir, outDir, melIC, mask_csf, mask_edge, mask_out)
+edgeFract, csfFract = aromafunc.mod_feature_spatial(melIC, mask_csf, mask_edge, mask_out)
 
 print('  - extracting the Maximum RP correlation feature')
 melmix = os.path.join(outDir, 'melodic.ica', 'melodic_mix')
@@ -164,9 +158,6 @@ classification_plots.classification_plot(os.path.join(outDir, 'classification_ov
 
 if (denType != 'no'):
     print('Step 3) Data denoising')
-    aromafunc.denoising(fslDir, inFile, outDir, melmix, denType, motionICs)
-
-# Revert to old directory
-os.chdir(cwd)
+    aromafunc.denoising(inFile, outDir, melmix, denType, motionICs, mask=mask)
 
 print('\n----------------------------------- Finished -----------------------------------\n')
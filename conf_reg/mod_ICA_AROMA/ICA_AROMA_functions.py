@@ -11,43 +11,46 @@ from builtins import range
 from past.utils import old_div
 import numpy as np
 
-def run_ICA_AROMA(outDir,inFile,mc,TR,mask="",mask_csf="",denType="nonaggr",melDir="",dim=0,overwrite=False):
+class AROMAError(Exception):
+    """Raised by run_ICA_AROMA when its inputs are invalid, instead of exiting the process."""
+    pass
+
+
+def run_ICA_AROMA(outDir,inFile,mc,TR,mask="",mask_csf="",denType="nonaggr",melDir="",dim=0,overwrite=False,in_img=None,mask_cache_dir=None,seed=None):
+    '''
+    Runs the modified ICA-AROMA. MELODIC is run on inFile, while the denoising is applied to in_img when the image
+    is already loaded in memory (otherwise inFile is read). Returns a dictionary of the denoised images for each
+    requested denoising type. The edge and out masks derived from the brain mask are cached in mask_cache_dir if provided.
+    The seed makes the maximum RP correlation feature reproducible.
+
+    The function is re-entrant, so that several scans can be processed by threads of the same process (see
+    run_ICA_AROMA_scans): it doesn't change the working directory, raises AROMAError on invalid inputs, and
+    writes all its outputs in a temporary directory next to outDir, which only replaces outDir once complete.
+    '''
     import os
     import subprocess
     import shutil
+    import tempfile
     import conf_reg.mod_ICA_AROMA.classification_plots as classification_plots
     import conf_reg.mod_ICA_AROMA.ICA_AROMA_functions as aromafunc
 
-    # Change to script directory
-    cwd = os.path.realpath(os.path.curdir)
-    scriptDir = os.path.dirname(os.path.abspath(__file__))
-    os.chdir(scriptDir)
-
     print('\n------------------------------- RUNNING ICA-AROMA ------------------------------- ')
     print('--------------- \'ICA-based Automatic Removal Of Motion Artifacts\' --------------- \n')
 
-    # Define variables based on the type of input (i.e. Feat directory or specific input arguments), and check whether the specified files exist.
-    cancel = False
-
     # Check whether the files exist
+    errors = []
     if not inFile:
-        print('No input file specified.')
-    else:
-        if not os.path.isfile(inFile):
-            print('The specified input file does not exist.')
-            cancel = True
+        errors.append('No input file specified.')
+    elif not os.path.isfile(inFile):
+        errors.append('The specified input file does not exist.')
     if not mc:
         print('No mc file specified.')
-    else:
-        if not os.path.isfile(mc):
-            print('The specified mc file does does not exist.')
-            cancel = True
+    elif not os.path.isfile(mc):
+        errors.append('The specified mc file does does not exist.')
 
     # Check if the mask exists, when specified.
-    if mask:
-        if not os.path.isfile(mask):
-            print('The specified mask does not exist.')
-            cancel = True
+    if mask and not os.path.isfile(mask):
+        errors.append('The specified mask does not exist.')
 
     # Check if the type of denoising is correctly specified, when specified
     if not (denType == 'nonaggr') and not (denType == 'aggr') and not (denType == 'both') and not (denType == 'no'):
@@ -55,32 +58,21 @@ def run_ICA_AROMA(outDir,inFile,mc,TR,mask="",mask_csf="",denType="nonaggr",melD
         denType = 'nonaggr'
 
     # If the criteria for file/directory specifications have not been met. Cancel ICA-AROMA.
-    if cancel:
-        print('\n----------------------------- ICA-AROMA IS CANCELED -----------------------------\n')
-        exit()
+    if len(errors) > 0:
+        raise AROMAError('ICA-AROMA is canceled: ' + ' '.join(errors))
 
     #------------------------------------------- PREPARE -------------------------------------------#
 
     # Define the FSL-bin directory
     fslDir = os.path.join(os.environ["FSLDIR"], 'bin', '')
 
-    # Create output directory if needed
+    outDir = os.path.abspath(outDir)
+    inFile = os.path.abspath(inFile)
     if os.path.isdir(outDir) and overwrite is False:
-        print('Output directory', outDir, """already exists.
-              AROMA will not continue.
-              Rerun with the -overwrite option to explicitly overwrite existing output.""")
-        exit()
-    elif os.path.isdir(outDir) and overwrite is True:
-        print('Warning! Output directory', outDir, 'exists and will be overwritten.\n')
-        shutil.rmtree(outDir)
-        os.makedirs(outDir)
-    else:
-        os.makedirs(outDir)
+        raise AROMAError('Output directory %s already exists. Rerun with overwrite=True to explicitly overwrite existing output.' % (outDir))
 
     # Get TR of the fMRI data, if not specified
-    if TR:
-        TR = TR
-    else:
+    if not TR:
         cmd = ' '.join([os.path.join(fslDir, 'fslinfo'),
                         inFile,
                         '| grep pixdim4 | awk \'{print $2}\''])
@@ -88,57 +80,77 @@ def run_ICA_AROMA(outDir,inFile,mc,TR,mask="",mask_csf="",denType="nonaggr",melD
 
     # Check TR
     if TR == 0:
-        print('TR is zero. ICA-AROMA requires a valid TR and will therefore exit. Please check the header, or define the TR as an additional argument.\n----------------------------- ICA-AROMA IS CANCELED -----------------------------\n')
-        exit()
-
-    # Define mask.
-    mask_cp = os.path.join(outDir, 'mask.nii.gz')
-    shutil.copyfile(mask, mask_cp)
-    mask=mask_cp
-
-
-    #---------------------------------------- Run ICA-AROMA ----------------------------------------#
-
-    print('Step 1) MELODIC')
-    aromafunc.runICA(fslDir, inFile, outDir, melDir, mask, dim, TR)
-    melIC = os.path.join(outDir, 'melodic_IC_thr.nii.gz')
-
-    print('Step 2) Automatic classification of the components')
-
-    print('  - *modified version skips commonspace registration')
-
-    print('  - computing edge and out masks')
-    mask_edge = os.path.join(outDir, 'mask_edge.nii.gz')
-    mask_out = os.path.join(outDir, 'mask_out.nii.gz')
-    aromafunc.compute_edge_mask(mask,mask_edge, num_edge_voxels=1)
-    aromafunc.compute_out_mask(mask,mask_out)
-
-    print('  - extracting the CSF & Edge fraction features')
-    #modified inputs for the spatial features, by providing the required masks manually
-    edgeFract, csfFract = aromafunc.mod_feature_spatial(fslDir, outDir, melIC, mask_csf, mask_edge, mask_out)
-
-    print('  - extracting the Maximum RP correlation feature')
-    melmix = os.path.join(outDir, 'melodic.ica', 'melodic_mix')
-    maxRPcorr = aromafunc.feature_time_series(melmix, mc)
-
-    print('  - extracting the High-frequency content feature')
-    melFTmix = os.path.join(outDir, 'melodic.ica', 'melodic_FTmix')
-    HFC = aromafunc.feature_frequency(melFTmix, TR)
-
-    print('  - classification')
-    motionICs = aromafunc.classification(outDir, maxRPcorr, edgeFract, HFC, csfFract)
-    classification_plots.classification_plot(os.path.join(outDir, 'classification_overview.txt'),
-                                             outDir)
+        raise AROMAError('TR is zero. ICA-AROMA requires a valid TR. Please check the header, or define the TR as an additional argument.')
+
+    # All the outputs of this call are written in its own temporary directory
+    os.makedirs(os.path.dirname(outDir), exist_ok=True)
+    workDir = tempfile.mkdtemp(prefix='.%s.' % (os.path.basename(outDir)), dir=os.path.dirname(outDir))
+    try:
+        # Define mask.
+        mask_cp = os.path.join(workDir, 'mask.nii.gz')
+        shutil.copyfile(mask, mask_cp)
+        mask = mask_cp
+
+        #---------------------------------------- Run ICA-AROMA ----------------------------------------#
+
+        print('Step 1) MELODIC')
+        melIC = aromafunc.runICA(fslDir, inFile, workDir, melDir, mask, dim, TR)
+
+        print('Step 2) Automatic classification of the components')
+
+        print('  - *modified version skips commonspace registration')
+
+        print('  - computing edge and out masks')
+        mask_edge = os.path.join(workDir, 'mask_edge.nii.gz')
+        mask_out = os.path.join(workDir, 'mask_out.nii.gz')
+        aromafunc.compute_edge_mask(mask,mask_edge, num_edge_voxels=1, cache_dir=mask_cache_dir)
+        aromafunc.compute_out_mask(mask,mask_out, cache_dir=mask_cache_dir)
+
+        print('  - extracting the CSF & Edge fraction features')
+        #modified inputs for the spatial features, by providing the required masks manually
+        edgeFract, csfFract = aromafunc.mod_feature_spatial(melIC, mask_csf, mask_edge, mask_out)
+
+        print('  - extracting the Maximum RP correlation feature')
+        melmix = os.path.join(workDir, 'melodic.ica', 'melodic_mix')
+        maxRPcorr = aromafunc.feature_time_series(melmix, mc, seed=seed)
+
+        print('  - extracting the High-frequency content feature')
+        melFTmix = os.path.join(workDir, 'melodic.ica', 'melodic_FTmix')
+        HFC = aromafunc.feature_frequency(melFTmix, TR)
+
+        print('  - classification')
+        motionICs = aromafunc.classification(workDir, maxRPcorr, edgeFract, HFC, csfFract)
+        classification_plots.classification_plot(os.path.join(workDir, 'classification_overview.txt'),
+                                                 workDir)
+
+        denoised = {}
+        if (denType != 'no'):
+            print('Step 3) Data denoising')
+            if in_img is None:
+                in_img = inFile
+            denoised = aromafunc.denoising(in_img, workDir, melmix, denType, motionICs, mask=mask)
+
+        if os.path.isdir(outDir):
+            print('Warning! Output directory', outDir, 'exists and will be overwritten.\n')
+            shutil.rmtree(outDir)
+        os.replace(workDir, outDir)
+    except BaseException:
+        shutil.rmtree(workDir, ignore_errors=True)
+        raise
 
+    print('\n----------------------------------- Finished -----------------------------------\n')
+    return denoised
 
-    if (denType != 'no'):
-        print('Step 3) Data denoising')
-        aromafunc.denoising(fslDir, inFile, outDir, melmix, denType, motionICs)
 
-    # Revert to old directory
-    os.chdir(cwd)
+def run_ICA_AROMA_scans(jobs, n_workers=1):
+    """Runs run_ICA_AROMA for several scans with a pool of n_workers threads, so that the phases spent waiting for
+    MELODIC or on I/O overlap across scans. jobs is a list of dictionaries of the keyword arguments of each call, and the
+    results are returned in the same order. An exception raised for any scan is raised once all the calls completed."""
+    from concurrent.futures import ThreadPoolExecutor
 
-    print('\n----------------------------------- Finished -----------------------------------\n')
+    with ThreadPoolExecutor(max(1, n_workers)) as executor:
+        futures = [executor.submit(run_ICA_AROMA, **job) for job in jobs]
+    return [future.result() for future in futures]
 
 
 def runICA(fslDir, inFile, outDir, melDirIn, mask, dim, TR):
@@ -154,6 +166,10 @@ def runICA(fslDir, inFile, outDir, melDirIn, mask, dim, TR):
     dim:        Dimensionality of ICA
     TR:     TR (in seconds) of the fMRI data
 
+    Returns
+    ---------------------------------------------------------------------------------
+    melICthr_array:     4D array of the merged mixture modeling thresholded Z-statistical maps (as written to melodic_IC_thr.nii.gz)
+
     Output (within the requested output directory)
     ---------------------------------------------------------------------------------
     melodic.ica     MELODIC directory
@@ -161,7 +177,8 @@ def runICA(fslDir, inFile, outDir, melDirIn, mask, dim, TR):
 
     # Import needed modules
     import os
-    import subprocess
+    import numpy as np
+    import nibabel as nb
 
     # Define the 'new' MELODIC directory and predefine some associated files
     melDir = os.path.join(outDir, 'melodic.ica')
@@ -216,48 +233,33 @@ def runICA(fslDir, inFile, outDir, melDirIn, mask, dim, TR):
                             '--Ostats --nobet --mmthresh=0.5 --report',
                             '--tr=' + str(TR)]))
 
-    # Get number of components
-    cmd = ' '.join([os.path.join(fslDir, 'fslinfo'),
-                    melIC,
-                    '| grep dim4 | head -n1 | awk \'{print $2}\''])
-    nrICs = int(float(subprocess.getoutput(cmd)))
+    # Get number of components from the header
+    melIC_img = nb.load(melIC)
+    nrICs = melIC_img.shape[3] if len(melIC_img.shape) > 3 else 1
 
     # Merge mixture modeled thresholded spatial maps. Note! In case that mixture modeling did not converge, the file will contain two spatial maps. The latter being the results from a simple null hypothesis test. In that case, this map will have to be used (first one will be empty).
+    # The last spatial map of each thresh_zstat file is read directly and stacked in memory, rather than extracted and merged with fslroi/fslmerge.
+    mask_array = np.asarray(nb.load(mask).dataobj) > 0
+    melICthr_array = np.zeros(melIC_img.shape[:3] + (nrICs,), dtype=np.float32)
     for i in range(1, nrICs + 1):
         # Define thresholded zstat-map file
-        zTemp = os.path.join(melDir, 'stats', 'thresh_zstat' + str(i) + '.nii.gz')
-        cmd = ' '.join([os.path.join(fslDir, 'fslinfo'),
-                        zTemp,
-                        '| grep dim4 | head -n1 | awk \'{print $2}\''])
-        lenIC = int(float(subprocess.getoutput(cmd)))
-
-        # Define zeropad for this IC-number and new zstat file
-        cmd = ' '.join([os.path.join(fslDir, 'zeropad'),
-                        str(i),
-                        '4'])
-        ICnum = subprocess.getoutput(cmd)
-        zstat = os.path.join(outDir, 'thr_zstat' + ICnum)
+        zTemp = nb.load(os.path.join(melDir, 'stats', 'thresh_zstat' + str(i) + '.nii.gz'))
 
         # Extract last spatial map within the thresh_zstat file
-        os.system(' '.join([os.path.join(fslDir, 'fslroi'),
-                            zTemp,      # input
-                            zstat,      # output
-                            str(lenIC - 1),   # first frame
-                            '1']))      # number of frames
+        if len(zTemp.shape) > 3:
+            zstat = zTemp.dataobj[:, :, :, zTemp.shape[3] - 1]
+        else:
+            zstat = zTemp.dataobj[:, :, :]
 
-    # Merge and subsequently remove all mixture modeled Z-maps within the output directory
-    os.system(' '.join([os.path.join(fslDir, 'fslmerge'),
-                        '-t',                       # concatenate in time
-                        melICthr,                   # output
-                        os.path.join(outDir, 'thr_zstat????.nii.gz')]))  # inputs
+        # Apply the mask (in case a melodic-directory was predefined and run with a different mask)
+        melICthr_array[:, :, :, i - 1] = np.asarray(zstat).reshape(mask_array.shape) * mask_array
 
-    os.system('rm ' + os.path.join(outDir, 'thr_zstat????.nii.gz'))
+    # Write the merged file once
+    header = melIC_img.header.copy()
+    header.set_data_dtype(np.float32)
+    nb.Nifti1Image(melICthr_array, melIC_img.affine, header).to_filename(melICthr)
 
-    # Apply the mask to the merged file (in case a melodic-directory was predefined and run with a different mask)
-    os.system(' '.join([os.path.join(fslDir, 'fslmaths'),
-                        melICthr,
-                        '-mas ' + mask,
-                        melICthr]))
+    return melICthr_array
 
 
 def register2MNI(fslDir, inFile, outFile, affmat, warp):
@@ -339,15 +341,53 @@ def cross_correlation(a, b):
     return np.corrcoef(a.T, b.T)[:ncols_a, ncols_a:]
 
 
-def feature_time_series(melmix, mc):
+def _split_max_correlations(excluded_rows, series, totals, nrows_chosen):
+    """Maximum absolute correlation of each IC with the RP model for a batch of splits.
+
+    excluded_rows:  (nsplits x nexcluded) array with the rows left out from each split
+    series:         Pairs of centred (IC, RP) series, non squared then squared, as built by feature_time_series
+    totals:         Sums of squares and cross products of each pair of series over all rows"""
+    import numpy as np
+
+    max_correls = None
+    for (a, b), (Saa, Sbb, Sab) in zip(series, totals):
+        # The sums over the chosen rows are the totals minus the sums over the (few) excluded rows, whose
+        # IC-by-RP cross products are computed for all the splits by a single batched matrix product
+        a_excluded = a[excluded_rows]
+        b_excluded = b[excluded_rows]
+        # the series are centred, so the sums over the chosen rows are minus the sums over the excluded rows
+        Sa = -a_excluded.sum(axis=1)
+        Sb = -b_excluded.sum(axis=1)
+        var_a = Saa - (a_excluded ** 2).sum(axis=1) - Sa ** 2 / nrows_chosen
+        var_b = Sbb - (b_excluded ** 2).sum(axis=1) - Sb ** 2 / nrows_chosen
+        # constant series have no defined correlation, as with np.corrcoef
+        var_a[var_a <= np.finfo(np.float64).eps * Saa] = np.nan
+        var_b[var_b <= np.finfo(np.float64).eps * Sbb] = np.nan
+        cov = Sab - np.matmul(a_excluded.transpose(0, 2, 1), b_excluded) - Sa[:, :, np.newaxis] * Sb[:, np.newaxis, :] / nrows_chosen
+        correl = cov / np.sqrt(var_a[:, :, np.newaxis] * var_b[:, np.newaxis, :])
+
+        # Maximum absolute temporal correlation for every IC (nans are propagated as with np.max)
+        split_max = np.abs(correl).max(axis=2)
+        max_correls = split_max if max_correls is None else np.maximum(max_correls, split_max)
+
+    return max_correls
+
+
+def feature_time_series(melmix, mc, nsplits=1000, seed=None, batch_size=100):
     """ This function extracts the maximum RP correlation feature scores.
     It determines the maximum robust correlation of each component time-series
     with a model of 72 realignment parameters.
+    The correlations for all random splits are computed in batches from the sums over all time-points,
+    minus the sums over the rows excluded from each split, only evaluating the cross-correlations
+    between the ICs and the realignment parameters.
 
     Parameters
     ---------------------------------------------------------------------------------
     melmix:     Full path of the melodic_mix text file
     mc:     Full path of the text file containing the realignment parameters
+    nsplits:    Number of random splits of 90% of the time-points
+    seed:       Seed of the random number generator, for reproducible feature scores
+    batch_size: Number of splits computed at once
 
     Returns
     ---------------------------------------------------------------------------------
@@ -356,10 +396,11 @@ def feature_time_series(melmix, mc):
 
     # Import required modules
     import numpy as np
-    import random
 
     # Read melodic mix file (IC time-series), subsequently define a set of squared time-series
     mix = np.loadtxt(melmix)
+    if mix.ndim == 1:
+        mix = mix[:, np.newaxis]
 
     # Read motion parameter file
     rp6 = np.loadtxt(mc)
@@ -386,26 +427,32 @@ def feature_time_series(melmix, mc):
     rp_model = np.hstack((rp12, rp12_1fw, rp12_1bw))
 
     # Determine the maximum correlation between RPs and IC time-series
-    nsplits = 1000
     nmixrows, nmixcols = mix.shape
     nrows_to_choose = int(round(0.9 * nmixrows))
 
+    # Centre the non squared and squared series over all rows (for numerical stability), and compute their
+    # sums of squares and IC-by-RP cross products over all rows
+    series = []
+    totals = []
+    for a, b in [(mix, rp_model), (mix ** 2, rp_model ** 2)]:
+        a = a - a.mean(axis=0)
+        b = b - b.mean(axis=0)
+        series.append((a, b))
+        totals.append(((a ** 2).sum(axis=0), (b ** 2).sum(axis=0), a.T.dot(b)))
+
+    # Each batch of splits is drawn from its own child seed
+    batch_sizes = [min(batch_size, nsplits - i) for i in range(0, nsplits, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+
     # Max correlations for multiple splits of the dataset (for a robust estimate)
-    max_correls = np.empty((nsplits, nmixcols))
-    for i in range(nsplits):
-        # Select a random subset of 90% of the dataset rows (*without* replacement)
-        chosen_rows = random.sample(population=range(nmixrows),
-                                    k=nrows_to_choose)
-
-        # Combined correlations between RP and IC time-series, squared and non squared
-        correl_nonsquared = cross_correlation(mix[chosen_rows],
-                                              rp_model[chosen_rows])
-        correl_squared = cross_correlation(mix[chosen_rows]**2,
-                                           rp_model[chosen_rows]**2)
-        correl_both = np.hstack((correl_squared, correl_nonsquared))
-
-        # Maximum absolute temporal correlation for every IC
-        max_correls[i] = np.abs(correl_both).max(axis=1)
+    max_correls = []
+    for n, batch_seed in zip(batch_sizes, seeds):
+        # Select a random subset of 90% of the dataset rows (*without* replacement), by drawing the excluded rows
+        rng = np.random.default_rng(batch_seed)
+        excluded_rows = np.argsort(rng.random((n, nmixrows)), axis=1)[:, :nmixrows - nrows_to_choose]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            max_correls.append(_split_max_correlations(excluded_rows, series, totals, nrows_to_choose))
+    max_correls = np.vstack(max_correls)
 
     # Feature score is the mean of the maximum correlation over all the random splits
     # Avoid propagating occasional nans that arise in artificial test cases
@@ -463,154 +510,128 @@ def feature_frequency(melFTmix, TR):
     # Return feature score
     return HFC
 
-def compute_edge_mask(in_mask,out_file, num_edge_voxels):
+def _file_hash(filename):
+    """Returns the sha1 digest of the content of a file."""
+    import hashlib
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _cached_mask(in_mask, out_file, name, compute, cache_dir=None):
+    """Writes to out_file the mask derived from in_mask with compute(mask_array). When cache_dir is provided, the
+    result is cached there using the content of in_mask as key, so that scans sharing the same template mask reuse
+    it. No state is kept in the process, so that concurrent scans only share the cache through its files."""
+    import os
+    import shutil
+    import tempfile
     import numpy as np
     import nibabel as nb
-    img=nb.load(in_mask)
-    mask_array=np.asarray(img.dataobj)
-    shape=mask_array.shape
-
-    #iterate through all voxels from the three dimensions and look if it contains surrounding voxels
-    edge_mask=np.zeros(shape, dtype=bool)
-    num_voxel=0
-    while num_voxel<num_edge_voxels:
-        for x in range(shape[0]):
-            for y in range(shape[1]):
-                for z in range(shape[2]):
-                    #only look if the voxel is part of the mask
-                    if mask_array[x,y,z]:
-                        if (mask_array[x-1:x+2,y-1:y+2,z-1:z+2]==0).sum()>0:
-                            edge_mask[x,y,z]=1
-        mask_array=mask_array-edge_mask
-        num_voxel+=1
-
-    nb.Nifti1Image(edge_mask, img.affine, img.header).to_filename(out_file)
-
-def compute_out_mask(in_mask,out_file):
+
+    img = nb.load(in_mask)
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, '%s_%s.nii.gz' % (_file_hash(in_mask), name))
+
+    if cache_file is not None and os.path.isfile(cache_file):
+        out_array = np.asarray(nb.load(cache_file).dataobj).astype(bool)
+    else:
+        out_array = compute(np.asarray(img.dataobj) > 0)
+        if cache_file is not None:
+            # write to a temporary file first so that concurrent scans never read a partial file
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp_file = tempfile.mkstemp(suffix='.nii.gz', dir=cache_dir)
+            os.close(fd)
+            nb.Nifti1Image(out_array.astype(np.uint8), img.affine, img.header).to_filename(tmp_file)
+            os.replace(tmp_file, cache_file)
+
+    if cache_file is not None and os.path.isfile(cache_file):
+        shutil.copyfile(cache_file, out_file)
+    else:
+        nb.Nifti1Image(out_array.astype(np.uint8), img.affine, img.header).to_filename(out_file)
+    return out_array
+
+
+def compute_edge_mask(in_mask,out_file, num_edge_voxels=1, cache_dir=None):
+    """Computes the mask of the num_edge_voxels outer layers of the brain mask, by successive binary erosions with a
+    3x3x3 structuring element. Voxels on the border of the volume count as edge voxels."""
     import numpy as np
-    import nibabel as nb
-    img=nb.load(in_mask)
-    mask_array=np.asarray(img.dataobj)
+    from scipy import ndimage
+
+    def compute(mask_array):
+        structure = np.ones((3, 3, 3), dtype=bool)
+        eroded = ndimage.binary_erosion(mask_array, structure=structure, iterations=num_edge_voxels, border_value=0)
+        return mask_array & ~eroded
 
-    #iterate through all voxels from the three dimensions and look if it contains surrounding voxels
-    out_mask=np.asarray(mask_array==0,dtype=bool)
-    nb.Nifti1Image(out_mask, img.affine, img.header).to_filename(out_file)
+    return _cached_mask(in_mask, out_file, 'edge%i' % num_edge_voxels, compute, cache_dir=cache_dir)
 
+def compute_out_mask(in_mask,out_file, cache_dir=None):
+    """Computes the mask of the voxels outside the brain mask."""
 
-def mod_feature_spatial(fslDir, tempDir, melIC, mask_csf, mask_edge, mask_out):
+    def compute(mask_array):
+        return ~mask_array
+
+    return _cached_mask(in_mask, out_file, 'out', compute, cache_dir=cache_dir)
+
+
+def mod_feature_spatial(melIC, mask_csf, mask_edge, mask_out):
     """ This is a modified version of the orginial ICA-AROMA function where the CSF and edge masks are provided manually.
     This function extracts the spatial feature scores. For each IC it determines the fraction of the mixture modeled thresholded Z-maps respecitvely located within the CSF or at the brain edges, using predefined standardized masks.
+    Rather than extracting each IC with fslroi/fslmaths and querying fslstats, the thresholded Z-maps and the masks are loaded once,
+    and the masked sums of absolute Z-values are computed for all ICs in a single pass over the 4D array.
 
     Parameters
     ---------------------------------------------------------------------------------
-    fslDir:     Full path of the bin-directory of FSL
-    tempDir:    Full path of a directory where temporary files can be stored (called 'temp_IC.nii.gz')
-    melIC:      Full path of the nii.gz file containing mixture-modeled threholded (p>0.5) Z-maps, which overlays with the provided masks.
+    melIC:      Full path of the nii.gz file containing mixture-modeled threholded (p>0.5) Z-maps, which overlays with the provided masks,
+                or the corresponding 4D array as returned by runICA
+    mask_csf:   Full path of the CSF mask
+    mask_edge:  Full path of the edge mask
+    mask_out:   Full path of the mask of voxels outside the brain
 
     Returns
     ---------------------------------------------------------------------------------
     edgeFract:  Array of the edge fraction feature scores for the components of the melIC file
+                (0 for the components with all their weight within the CSF)
     csfFract:   Array of the CSF fraction feature scores for the components of the melIC file"""
 
     # Import required modules
     import numpy as np
-    import os
-    import subprocess
-
-    # Get the number of ICs
-    numICs = int(subprocess.getoutput('%sfslinfo %s | grep dim4 | head -n1 | awk \'{print $2}\'' % (fslDir, melIC) ))
+    import nibabel as nb
 
-    # Loop over ICs
+    # Load the ICs as a (voxels x ICs) array of absolute Z-values (equivalent to fslmaths -abs)
+    if isinstance(melIC, str):
+        melIC = nb.load(melIC).dataobj
+    IC_array = np.asarray(melIC, dtype=np.float32)
+    if IC_array.ndim == 3:
+        IC_array = IC_array[:, :, :, np.newaxis]
+    numICs = IC_array.shape[3]
+    IC_array = np.abs(IC_array.reshape(-1, numICs, order='F'))
+
+    # Stack the whole-volume, CSF, edge and out masks (equivalent to fslstats -k) as the columns of a (voxels x 4) matrix
+    masks = [np.ones(IC_array.shape[0], dtype=np.float64)]
+    for mask_file in [mask_csf, mask_edge, mask_out]:
+        masks.append((np.asarray(nb.load(mask_file).dataobj).reshape(-1, order='F') > 0).astype(np.float64))
+    masks = np.stack(masks, axis=1)
+
+    # Sum of Z-values within each mask for every IC (the non-zero voxel mean times the number of non-zero voxels in fslstats)
+    sums = np.dot(masks.T, IC_array.astype(np.float64))
+    totSum, csfSum, edgeSum, outSum = sums
+
+    for i in np.where((IC_array > 0).sum(axis=0) == 0)[0]:
+        print('     - The spatial map of component ' + str(i + 1) + ' is empty. Please check!')
+
+    # Determine edge and CSF fraction
     edgeFract = np.zeros(numICs)
     csfFract = np.zeros(numICs)
-    for i in range(0, numICs):
-        # Define temporary IC-file
-        tempIC = os.path.join(tempDir, 'temp_IC.nii.gz')
-
-        # Extract IC from the merged melodic_IC_thr2MNI2mm file
-        os.system(' '.join([os.path.join(fslDir, 'fslroi'),
-                  melIC,
-                  tempIC,
-                  str(i),
-                  '1']))
-
-        # Change to absolute Z-values
-        os.system(' '.join([os.path.join(fslDir, 'fslmaths'),
-                  tempIC,
-                  '-abs',
-                  tempIC]))
-
-        # Get sum of Z-values within the total Z-map (calculate via the mean and number of non-zero voxels)
-        totVox = int(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                    tempIC,
-                                                    '-V | awk \'{print $1}\''])))
-
-        if not (totVox == 0):
-            totMean = float(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                           tempIC,
-                                                           '-M'])))
-        else:
-            print('     - The spatial map of component ' + str(i + 1) + ' is empty. Please check!')
-            totMean = 0
-
-        totSum = totMean * totVox
-
-        # Get sum of Z-values of the voxels located within the CSF (calculate via the mean and number of non-zero voxels)
-        csfVox = int(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                    tempIC,
-                                                    '-k ', mask_csf,
-                                                    '-V | awk \'{print $1}\''])))
-
-        if not (csfVox == 0):
-            csfMean = float(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                           tempIC,
-                                                           '-k ', mask_csf,
-                                                           '-M'])))
-        else:
-            csfMean = 0
-
-        csfSum = csfMean * csfVox
-
-        # Get sum of Z-values of the voxels located within the Edge (calculate via the mean and number of non-zero voxels)
-        edgeVox = int(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                     tempIC,
-                                                     '-k ', mask_edge,
-                                                     '-V | awk \'{print $1}\''])))
-        if not (edgeVox == 0):
-            edgeMean = float(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                            tempIC,
-                                                            '-k ', mask_edge,
-                                                            '-M'])))
-        else:
-            edgeMean = 0
-
-        edgeSum = edgeMean * edgeVox
-
-        # Get sum of Z-values of the voxels located outside the brain (calculate via the mean and number of non-zero voxels)
-        outVox = int(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                    tempIC,
-                                                    '-k ', mask_out,
-                                                    '-V | awk \'{print $1}\''])))
-        if not (outVox == 0):
-            outMean = float(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                           tempIC,
-                                                           '-k ', mask_out,
-                                                           '-M'])))
-        else:
-            outMean = 0
-
-        outSum = outMean * outVox
-
-        # Determine edge and CSF fraction
-        if not (totSum == 0):
-            edgeFract[i] = old_div((outSum + edgeSum), (totSum - csfSum))
-            csfFract[i] = old_div(csfSum, totSum)
-        else:
-            edgeFract[i] = 0
-            csfFract[i] = 0
-
-    # Remove the temporary IC-file
-    os.remove(tempIC)
+    nonzero = totSum != 0
+    # The edge fraction is relative to the weight outside the CSF. A component with all its weight within the CSF
+    # (up to rounding of the sums) has no defined edge fraction, which is set to 0; it is classified as motion
+    # by its CSF fraction anyway
+    noncsf = totSum - csfSum > np.finfo(np.float32).eps * totSum
+    edgeFract[noncsf] = (outSum[noncsf] + edgeSum[noncsf]) / (totSum[noncsf] - csfSum[noncsf])
+    csfFract[nonzero] = csfSum[nonzero] / totSum[nonzero]
 
     # Return feature scores
     return edgeFract, csfFract
@@ -622,7 +643,7 @@ def feature_spatial(fslDir, tempDir, aromaDir, melIC):
     Parameters
     ---------------------------------------------------------------------------------
     fslDir:     Full path of the bin-directory of FSL
-    tempDir:    Full path of a directory where temporary files can be stored (called 'temp_IC.nii.gz')
+    tempDir:    Full path of a directory where temporary files can be stored (a unique 'temp_IC_*.nii.gz' per call)
     aromaDir:   Full path of the ICA-AROMA directory, containing the mask-files (mask_edge.nii.gz, mask_csf.nii.gz & mask_out.nii.gz)
     melIC:      Full path of the nii.gz file containing mixture-modeled threholded (p>0.5) Z-maps, registered to the MNI152 2mm template
 
@@ -635,6 +656,7 @@ def feature_spatial(fslDir, tempDir, aromaDir, melIC):
     import numpy as np
     import os
     import subprocess
+    import tempfile
 
     # Get the number of ICs
     numICs = int(subprocess.getoutput('%sfslinfo %s | grep dim4 | head -n1 | awk \'{print $2}\'' % (fslDir, melIC) ))
@@ -642,9 +664,10 @@ def feature_spatial(fslDir, tempDir, aromaDir, melIC):
     # Loop over ICs
     edgeFract = np.zeros(numICs)
     csfFract = np.zeros(numICs)
+    # Define temporary IC-file, unique to this call
+    fd, tempIC = tempfile.mkstemp(prefix='temp_IC_', suffix='.nii.gz', dir=tempDir)
+    os.close(fd)
     for i in range(0, numICs):
-        # Define temporary IC-file
-        tempIC = os.path.join(tempDir, 'temp_IC.nii.gz')
 
         # Extract IC from the merged melodic_IC_thr2MNI2mm file
         os.system(' '.join([os.path.join(fslDir, 'fslroi'),
@@ -677,13 +700,13 @@ def feature_spatial(fslDir, tempDir, aromaDir, melIC):
         # Get sum of Z-values of the voxels located within the CSF (calculate via the mean and number of non-zero voxels)
         csfVox = int(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
                                                     tempIC,
-                                                    '-k mask_csf.nii.gz',
+                                                    '-k ' + os.path.join(aromaDir, 'mask_csf.nii.gz'),
                                                     '-V | awk \'{print $1}\''])))
 
         if not (csfVox == 0):
             csfMean = float(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
                                                            tempIC,
-                                                           '-k mask_csf.nii.gz',
+                                                           '-k ' + os.path.join(aromaDir, 'mask_csf.nii.gz'),
                                                            '-M'])))
         else:
             csfMean = 0
@@ -693,12 +716,12 @@ def feature_spatial(fslDir, tempDir, aromaDir, melIC):
         # Get sum of Z-values of the voxels located within the Edge (calculate via the mean and number of non-zero voxels)
         edgeVox = int(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
                                                      tempIC,
-                                                     '-k mask_edge.nii.gz',
+                                                     '-k ' + os.path.join(aromaDir, 'mask_edge.nii.gz'),
                                                      '-V | awk \'{print $1}\''])))
         if not (edgeVox == 0):
             edgeMean = float(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
                                                             tempIC,
-                                                            '-k mask_edge.nii.gz',
+                                                            '-k ' + os.path.join(aromaDir, 'mask_edge.nii.gz'),
                                                             '-M'])))
         else:
             edgeMean = 0
@@ -708,12 +731,12 @@ def feature_spatial(fslDir, tempDir, aromaDir, melIC):
         # Get sum of Z-values of the voxels located outside the brain (calculate via the mean and number of non-zero voxels)
         outVox = int(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
                                                     tempIC,
-                                                    '-k mask_out.nii.gz',
+                                                    '-k ' + os.path.join(aromaDir, 'mask_out.nii.gz'),
                                                     '-V | awk \'{print $1}\''])))
         if not (outVox == 0):
             outMean = float(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
                                                            tempIC,
-                                                           '-k mask_out.nii.gz',
+                                                           '-k ' + os.path.join(aromaDir, 'mask_out.nii.gz'),
                                                            '-M'])))
         else:
             outMean = 0
@@ -812,18 +835,81 @@ def classification(outDir, maxRPcorr, edgeFract, HFC, csfFract):
     return motionICs
 
 
-def denoising(fslDir, inFile, outDir, melmix, denType, denIdx):
-    """ This function classifies the ICs based on the four features;
-    maximum RP correlation, high-frequency content, edge-fraction and CSF-fraction
+def denoise_timeseries(data, melmix, denIdx, denType='nonaggr', chunk_size=20000):
+    """ This function applies the (partial) regression of the motion components, as in fsl_regfilt, to a time x voxel array.
+    The full melodic_mix design is fitted once per chunk of voxels, and the non-aggressive and/or aggressive outputs are
+    derived from that single fit.
 
     Parameters
     ---------------------------------------------------------------------------------
-    fslDir:     Full path of the bin-directory of FSL
-    inFile:     Full path to the data file (nii.gz) which has to be denoised
+    data:       Time x voxel array of the timeseries to denoise
+    melmix:     Full path of the melodic_mix text file, or the corresponding array
+    denIdx:     Indices of the components that should be regressed out
+    denType:    Type of requested denoising ('aggr': aggressive, 'nonaggr': non-aggressive, 'both': both aggressive and non-aggressive
+    chunk_size: Number of voxels processed at once
+
+    Returns
+    ---------------------------------------------------------------------------------
+    denoised:   Dictionary with the denoised float32 time x voxel array for each requested type ('nonaggr' and/or 'aggr')"""
+
+    # Import required modules
+    import numpy as np
+
+    den_types = []
+    if (denType == 'nonaggr') or (denType == 'both'):
+        den_types.append('nonaggr')
+    if (denType == 'aggr') or (denType == 'both'):
+        den_types.append('aggr')
+    denIdx = np.atleast_1d(denIdx).astype(int)
+    n_vols, n_voxels = data.shape
+
+    # Demeaned design, as in fsl_regfilt. Since the design columns have zero mean,
+    # the fitted coefficients are unaffected by the voxel means, which therefore don't need to be removed from the data.
+    if isinstance(melmix, str):
+        melmix = np.loadtxt(melmix)
+    design = np.asarray(melmix, dtype=np.float64).reshape(n_vols, -1)
+    design = design - design.mean(axis=0)
+    noise_design = design[:, denIdx]
+
+    # Stack the projections for each requested type, so that a single product fits all of them:
+    # non-aggressive uses the noise rows of the full design fit, aggressive fits the noise components alone
+    projections = []
+    if 'nonaggr' in den_types:
+        projections.append(np.linalg.pinv(design)[denIdx, :])
+    if 'aggr' in den_types:
+        projections.append(np.linalg.pinv(noise_design))
+    projection = np.concatenate(projections, axis=0)
+    n_noise = denIdx.size
+
+    denoised = {}
+    for den in den_types:
+        denoised[den] = np.empty((n_vols, n_voxels), dtype=np.float32)
+    for start in range(0, n_voxels, chunk_size):
+        chunk = np.asarray(data[:, start:start + chunk_size], dtype=np.float64)
+        betas = np.dot(projection, chunk)
+        for j, den in enumerate(den_types):
+            denoised[den][:, start:start + chunk_size] = chunk - np.dot(noise_design, betas[j * n_noise:(j + 1) * n_noise])
+    return denoised
+
+
+def denoising(inFile, outDir, melmix, denType, denIdx, mask=None, chunk_size=20000):
+    """ This function denoises the data by (partial) regression of the components classified as motion,
+    equivalent to fsl_regfilt but computed in-process (see denoise_timeseries). The input is read once,
+    and the non-aggressive and/or aggressive outputs are derived from a single fit of the melodic_mix design.
+
+    Parameters
+    ---------------------------------------------------------------------------------
+    inFile:     Full path to the data file (nii.gz) which has to be denoised, or the corresponding nibabel image already in memory
     outDir:     Full path of the output directory
     melmix:     Full path of the melodic_mix text file
     denType:    Type of requested denoising ('aggr': aggressive, 'nonaggr': non-aggressive, 'both': both aggressive and non-aggressive
     denIdx:     Indices of the components that should be regressed out
+    mask:       Full path of a mask restricting the voxels to denoise (voxels outside the mask are left unchanged). All voxels are denoised if None.
+    chunk_size: Number of voxels processed at once
+
+    Returns
+    ---------------------------------------------------------------------------------
+    denoised:   Dictionary with the denoised nibabel image for each requested type ('nonaggr' and/or 'aggr')
 
     Output (within the requested output directory)
     ---------------------------------------------------------------------------------
@@ -832,37 +918,50 @@ def denoising(fslDir, inFile, outDir, melmix, denType, denIdx):
     # Import required modules
     import os
     import numpy as np
+    import nibabel as nb
+
+    if isinstance(inFile, str):
+        img = nb.load(inFile)
+    else:
+        img = inFile
+
+    den_types = []
+    if (denType == 'nonaggr') or (denType == 'both'):
+        den_types.append('nonaggr')
+    if (denType == 'aggr') or (denType == 'both'):
+        den_types.append('aggr')
 
     # Check if denoising is needed (i.e. are there components classified as motion)
+    denIdx = np.atleast_1d(denIdx).astype(int)
     check = denIdx.size > 0
 
+    denoised = {}
     if check == 1:
-        # Put IC indices into a char array
-        if denIdx.size == 1:
-            denIdxStrJoin = "%d"%(denIdx + 1)
+        data = np.asarray(img.dataobj)
+        n_vols = data.shape[3]
+        data = data.reshape(-1, n_vols, order='F')
+        if mask is None:
+            voxels = np.arange(data.shape[0])
         else:
-            denIdxStr = np.char.mod('%i', (denIdx + 1))
-            denIdxStrJoin = ','.join(denIdxStr)
-
-        # Non-aggressive denoising of the data using fsl_regfilt (partial regression), if requested
-        if (denType == 'nonaggr') or (denType == 'both'):
-            os.system(' '.join([os.path.join(fslDir, 'fsl_regfilt'),
-                                '--in=' + inFile,
-                                '--design=' + melmix,
-                                '--filter="' + denIdxStrJoin + '"',
-                                '--out=' + os.path.join(outDir, 'denoised_func_data_nonaggr.nii.gz')]))
-
-        # Aggressive denoising of the data using fsl_regfilt (full regression)
-        if (denType == 'aggr') or (denType == 'both'):
-            os.system(' '.join([os.path.join(fslDir, 'fsl_regfilt'),
-                                '--in=' + inFile,
-                                '--design=' + melmix,
-                                '--filter="' + denIdxStrJoin + '"',
-                                '--out=' + os.path.join(outDir, 'denoised_func_data_aggr.nii.gz'),
-                                '-a']))
+            voxels = np.where(np.asarray(nb.load(mask).dataobj).reshape(-1, order='F') > 0)[0]
+
+        denoised_data = denoise_timeseries(data[voxels, :].T, melmix, denIdx, denType=denType, chunk_size=chunk_size)
+
+        header = img.header.copy()
+        header.set_data_dtype(np.float32)
+        for den in den_types:
+            output = data.astype(np.float32)
+            output[voxels, :] = denoised_data.pop(den).T
+            denoised[den] = nb.Nifti1Image(output.reshape(img.shape, order='F'), img.affine, header)
+            denoised[den].to_filename(os.path.join(outDir, 'denoised_func_data_' + den + '.nii.gz'))
     else:
-        print("  - None of the components were classified as motion, so no denoising is applied (a symbolic link to the input file will be created).")
-        if (denType == 'nonaggr') or (denType == 'both'):
-            os.symlink(inFile, os.path.join(outDir, 'denoised_func_data_nonaggr.nii.gz'))
-        if (denType == 'aggr') or (denType == 'both'):
-            os.symlink(inFile, os.path.join(outDir, 'denoised_func_data_aggr.nii.gz'))
+        print("  - None of the components were classified as motion, so no denoising is applied (the input data is passed through as output).")
+        for den in den_types:
+            den_file = os.path.join(outDir, 'denoised_func_data_' + den + '.nii.gz')
+            if isinstance(inFile, str):
+                os.symlink(inFile, den_file)
+            else:
+                img.to_filename(den_file)
+            denoised[den] = img
+
+    return denoised
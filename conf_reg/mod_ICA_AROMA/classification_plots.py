@@ -1,7 +1,16 @@
 from __future__ import print_function
+import threading
+
+# pyplot keeps a global current figure, so the plots of scans processed by concurrent threads are drawn one at a time
+_plot_lock = threading.Lock()
 
 
 def classification_plot(myinput, outDir):
+    with _plot_lock:
+        _classification_plot(myinput, outDir)
+
+
+def _classification_plot(myinput, outDir):
 
     import pandas as pd
     import numpy as np
@@ -206,6 +215,7 @@ def classification_plot(myinput, outDir):
     # outtakes
     plt.savefig(os.path.join(outDir, 'ICA_AROMA_component_assessment.pdf'),
                 bbox_inches='tight')
+    plt.close(fig)
 
     return
 
@@ -3,6 +3,9 @@ import numpy as np
 import nibabel as nb
 import pandas as pd
 
+# BIDS-style entities identifying a scan in the RABIES datasinks
+SCAN_ENTITIES=('sub', 'ses', 'run')
+
 def tree_list(dirName):
     # Get the list of all files in directory tree at given path
     listOfFiles = list()
@@ -10,49 +13,135 @@ def tree_list(dirName):
         listOfFiles += [os.path.join(dirpath, file) for file in filenames]
     return listOfFiles
 
+def scan_key(filename):
+    '''
+    Parses the (sub, ses, run) key of the scan of a file, from the last occurrence of each entity in its path
+    (None for a missing entity). Scan infos from get_info_list() give the same key as the files of their scan.
+    '''
+    import re
+    key=[]
+    for entity in SCAN_ENTITIES:
+        labels=re.findall(r'(?:^|[_/])%s-([a-zA-Z0-9]+)' % (entity), filename)
+        key.append(labels[-1] if len(labels)>0 else None)
+    return tuple(key)
+
 def get_info_list(file_list):
     info_list=[]
     for file in file_list:
         basename=os.path.basename(file)
-        file_info=basename.split('_run-')[0]+'_run-'+basename.split('_run-')[1][0]
+        #the whole run label is kept, so that run-10 is not taken for run-1
+        file_info=basename.split('_run-')[0]+'_run-'+scan_key(basename)[2]
         info_list.append(file_info)
 
     return info_list
 
+def scan_catalog(datasinks, catalog_file=None):
+    '''
+    Indexes the files of each datasink directory, given as a dictionary {file kind: directory}, by the
+    (sub, ses, run) key of their scan, into a dictionary {file kind: {key: file}}. With catalog_file, the
+    catalog is persisted as JSON along with the modification times of the walked directories, and is reused
+    without walking the datasinks again as long as none of these directories changed.
+    '''
+    import os
+    import json
+    from conf_reg.utils import scan_key
+
+    def mtime(directory):
+        return os.stat(directory).st_mtime_ns if os.path.isdir(directory) else None
 
-def find_scans(scan_info, bold_files, brain_mask_files, confounds_files, csf_mask_files, FD_files):
-    for file in bold_files:
-        if scan_info in file:
-            bold_file=file
-            break
-    for file in brain_mask_files:
-        if scan_info in file:
-            brain_mask_file=file
-            break
-    for file in confounds_files:
-        if scan_info in file:
-            confounds_file=file
-            break
-    for file in csf_mask_files:
-        if scan_info in file:
-            csf_mask=file
-            break
-    for file in FD_files:
-        if scan_info in file:
-            FD_file=file
-            break
-    return bold_file, brain_mask_file, confounds_file, csf_mask, FD_file
-
-def exec_ICA_AROMA(inFile, outDir, mc_file, brain_mask, csf_mask, tr, aroma_dim):
+    if catalog_file is not None and os.path.isfile(catalog_file):
+        with open(catalog_file) as f:
+            stored=json.load(f)
+        if stored['datasinks']==datasinks and all(mtime(directory)==stored_mtime for directory,stored_mtime in stored['directories'].items()):
+            return {kind:{tuple(key):file for key,file in files} for kind,files in stored['files'].items()}
+
+    directories={}
+    catalog={}
+    for kind,datasink in datasinks.items():
+        directories[datasink]=mtime(datasink)
+        files={}
+        for (dirpath, dirnames, filenames) in os.walk(datasink):
+            directories[dirpath]=mtime(dirpath)
+            for filename in sorted(filenames):
+                file=os.path.join(dirpath, filename)
+                key=scan_key(file)
+                if key in files:
+                    print('WARNING: %s and %s both match the scan %s in %s, the first is used.' % (files[key], file, key, datasink))
+                else:
+                    files[key]=file
+        catalog[kind]=files
+
+    if catalog_file is not None:
+        #written to a temporary file first, so that a concurrent run never reads a partial catalog
+        tmp_file='%s.%s.tmp' % (catalog_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump({'datasinks':datasinks, 'directories':directories,
+                       'files':{kind:[[list(key), file] for key,file in files.items()] for kind,files in catalog.items()}}, f)
+        os.replace(tmp_file, catalog_file)
+    return catalog
+
+def find_scans(scan_info, catalog):
+    '''
+    Looks up the files of a scan in the catalog from scan_catalog(), using the (sub, ses, run) key of its scan info.
+    '''
+    from conf_reg.utils import scan_key
+    key=scan_key(scan_info)
+    kinds=['bold', 'brain_mask', 'confounds', 'csf_mask', 'FD']
+    missing=[kind for kind in kinds if key not in catalog[kind]]
+    if len(missing)>0:
+        raise ValueError('No %s file found for the scan %s.' % (', '.join(missing), scan_info))
+    return tuple(catalog[kind][key] for kind in kinds)
+
+def exec_ICA_AROMA(outDir, mc_file, brain_mask, csf_mask, tr, aroma_dim, in_img=None, inFile=None, seed=0):
+    '''
+    Runs ICA-AROMA and returns a function applying the non-aggressive denoising to a time x voxel array (or a block
+    of its voxels), or None if no component is classified as motion. MELODIC is run on inFile if the smoothed image
+    was written, otherwise the in-memory in_img is handed to MELODIC through a temporary uncompressed file.
+    The edge/out masks derived from the brain mask are cached next to outDir, to be reused by scans sharing the same mask.
+    The seed of the maximum RP correlation feature makes the classification of the motion components reproducible.
+    '''
     import os
-    import conf_reg.utils
+    import tempfile
+    import nibabel as nb
     from conf_reg.mod_ICA_AROMA.ICA_AROMA_functions import run_ICA_AROMA
-    run_ICA_AROMA(os.path.abspath(outDir),os.path.abspath(inFile),mc=os.path.abspath(mc_file),TR=float(tr),mask=os.path.abspath(brain_mask),mask_csf=os.path.abspath(csf_mask),denType="nonaggr",melDir="",dim=str(aroma_dim),overwrite=True)
-    return os.path.abspath(outDir+'/denoised_func_data_nonaggr.nii.gz')
+    outDir=os.path.abspath(outDir)
+    mask_cache_dir=os.path.join(os.path.dirname(outDir), 'aroma_mask_cache')
+    tmp_file=None
+    if inFile is None:
+        fd,tmp_file=tempfile.mkstemp(prefix='melodic_input_', suffix='.nii', dir=os.path.dirname(outDir))
+        os.close(fd)
+        nb.save(in_img, tmp_file)
+        inFile=tmp_file
+    try:
+        run_ICA_AROMA(outDir,os.path.abspath(inFile),mc=os.path.abspath(mc_file),TR=float(tr),mask=os.path.abspath(brain_mask),mask_csf=os.path.abspath(csf_mask),denType="no",melDir="",dim=str(aroma_dim),overwrite=True,mask_cache_dir=mask_cache_dir,seed=seed)
+    finally:
+        if tmp_file is not None:
+            os.remove(tmp_file)
+
+    from conf_reg.utils import aroma_denoiser
+    return aroma_denoiser(outDir)
+
+def aroma_denoiser(outDir):
+    '''
+    Function applying the non-aggressive denoising of the ICA-AROMA run in outDir to a time x voxel array (or a block
+    of its voxels), or None if no component was classified as motion.
+    '''
+    import os
+    import numpy as np
+    from conf_reg.mod_ICA_AROMA.ICA_AROMA_functions import denoise_timeseries
+    with open(os.path.join(outDir, 'classified_motion_ICs.txt')) as f:
+        motion_ICs=f.read().strip()
+    if len(motion_ICs)==0:
+        return None
+    denIdx=np.asarray(motion_ICs.split(','), dtype=int)-1
+    melmix=np.loadtxt(os.path.join(outDir, 'melodic.ica', 'melodic_mix'))
+    def denoise(data):
+        return denoise_timeseries(data, melmix, denIdx, denType='nonaggr')['nonaggr']
+    return denoise
 
-def csv2par(in_confounds):
+def csv2par(in_confounds, interval=slice(None)):
     import pandas as pd
-    df=pd.read_csv(in_confounds)
+    df=pd.read_csv(in_confounds).iloc[interval]
     new_df=pd.DataFrame(columns=['mov1','mov2','mov3','rot1','rot2','rot3'])
     new_df['mov1']=df['mov1']
     new_df['mov2']=df['mov2']
@@ -64,135 +153,617 @@ def csv2par(in_confounds):
     new_df.to_csv(out_confounds, sep='\t', index=False, header=False)
     return out_confounds
 
-def scrubbing(img, FD_file, scrubbing_threshold,timeseries_interval):
+def scrubbing_mask(FD_file, scrubbing_threshold,timeseries_interval, frames_back=1, frames_forward=2):
     '''
     Scrubbing based on FD: The frames that exceed the given threshold together with 1 back
     and 2 forward frames will be masked out from the data (as in Power et al. 2012)
+    Returns the boolean mask of the frames to keep.
     '''
     import numpy as np
-    import nibabel as nb
     import pandas as pd
-    mean_FD=pd.read_csv(FD_file).get('Mean')
-    cutoff=np.asarray(mean_FD)>=scrubbing_threshold
-    mask=np.ones(len(mean_FD))
-    for i in range(len(mask)):
-        if cutoff[i]:
-            mask[i-1:i+2]=0
-
-    if not timeseries_interval=='all':
-        lowcut=int(timeseries_interval.split(',')[0])
-        highcut=int(timeseries_interval.split(',')[1])
-        mask=mask[lowcut:highcut]
-
-    masked_img=np.asarray(img.dataobj)[:,:,:,mask.astype(bool)]
-    return nb.Nifti1Image(masked_img, img.affine, img.header)
-
-def select_timeseries(bold_file,timeseries_interval):
-    import os
+    cutoff=np.asarray(pd.read_csv(FD_file).get('Mean'))>=scrubbing_threshold
+    censored=cutoff.copy()
+    for shift in range(1, frames_back+1):
+        censored[:-shift]|=cutoff[shift:]
+    for shift in range(1, frames_forward+1):
+        censored[shift:]|=cutoff[:-shift]
+    mask=~censored
+
+    from conf_reg.utils import parse_interval
+    return mask[parse_interval(timeseries_interval)]
+
+def parse_interval(timeseries_interval):
+    '''
+    Converts the --timeseries_interval specification ('all' or e.g. '0,80') into the slice of the
+    frames to keep, which is applied lazily when reading the BOLD timeseries and its confounds.
+    '''
+    if timeseries_interval=='all':
+        return slice(None)
+    try:
+        lowcut,highcut=[int(cut) for cut in timeseries_interval.split(',')]
+    except ValueError:
+        raise ValueError('The timeseries interval %s should be "all" or two frame indices, e.g. "0,80".' % (timeseries_interval))
+    return slice(lowcut,highcut)
+
+def report_precision(deviation, tolerance):
+    '''
+    Prints the deviation of the reduced precision cleaning from the float64 path, as measured by
+    cleaning.precision_check(), with a warning if it exceeds the tolerance.
+    '''
+    print('Reduced precision cleaning deviates from float64 by at most %.2e of the signal standard deviation.' % (deviation))
+    if deviation>tolerance:
+        print('WARNING: this is above the tolerance of %.0e, consider running with --dtype float64.' % (tolerance))
+
+# number of copies of the time x voxel array of a scan held at once by the batched cleaning of regress_batch()
+BATCH_COPIES=4
+
+# cleaning parameters which can be varied by the variants of a --sweep_spec
+SWEEP_PARAMETERS=('conf_list', 'lowpass', 'highpass', 'filter_type', 'apply_scrubbing', 'scrubbing_threshold')
+
+def load_sweep_spec(sweep_spec):
+    '''
+    Reads the variants of a sweep from a JSON file: a list of dictionaries with the cleaning parameters
+    (among SWEEP_PARAMETERS) which differ from the command line, and an optional 'name' of the output
+    subdirectory of the variant (variant-1, variant-2... by default).
+    '''
+    import json
+    from conf_reg.cleaning import FILTER_TYPES
+    with open(sweep_spec) as f:
+        sweep=json.load(f)
+    if not isinstance(sweep, list) or len(sweep)==0 or not all(isinstance(variant, dict) for variant in sweep):
+        raise ValueError('The sweep specification %s should be a non-empty list of dictionaries of parameters.' % (sweep_spec))
+    names=[]
+    for i,variant in enumerate(sweep):
+        variant.setdefault('name', 'variant-%s' % (i+1))
+        unknown=set(variant)-set(SWEEP_PARAMETERS)-{'name'}
+        if len(unknown)>0:
+            raise ValueError('Unknown parameters %s in the variant %s, the sweep can vary %s.' % (', '.join(sorted(unknown)), variant['name'], ', '.join(SWEEP_PARAMETERS)))
+        if not isinstance(variant['name'], str):
+            raise ValueError('The variant name %s should be a string.' % (variant['name'],))
+        if 'conf_list' in variant and not (isinstance(variant['conf_list'], list) and all(isinstance(conf, str) for conf in variant['conf_list'])):
+            raise ValueError('The conf_list of the variant %s should be a list of regressor names, e.g. ["mot_6"].' % (variant['name']))
+        #the filter cutoffs can be null to disable the filter
+        for parameter,nullable in [('lowpass', True), ('highpass', True), ('scrubbing_threshold', False)]:
+            if parameter not in variant or (nullable and variant[parameter] is None):
+                continue
+            if isinstance(variant[parameter], bool) or not isinstance(variant[parameter], (int, float)):
+                raise ValueError('The %s of the variant %s should be a number.' % (parameter, variant['name']))
+        if 'apply_scrubbing' in variant and not isinstance(variant['apply_scrubbing'], bool):
+            raise ValueError('The apply_scrubbing of the variant %s should be true or false.' % (variant['name']))
+        if variant.get('filter_type', FILTER_TYPES[0]) not in FILTER_TYPES:
+            raise ValueError('Unknown filter type %s in the variant %s, should be one of %s.' % (variant['filter_type'], variant['name'], ', '.join(FILTER_TYPES)))
+        if '/' in variant['name'] or variant['name'] in ['', '.', '..']:
+            raise ValueError('The variant name %s is not a valid directory name.' % (variant['name']))
+        names.append(variant['name'])
+    if len(set(names))<len(names):
+        raise ValueError('The variant names of the sweep %s should be unique.' % (sweep_spec))
+    return sweep
+
+def confound_regressors(confounds_file, FD_file, conf_list):
+    '''
+    Reads the regressors of conf_list from the confounds csv (and the FD csv for mean_FD), and returns the
+    list of their names and the list of their timeseries.
+    '''
     import numpy as np
-    import nibabel as nb
-    img=nb.load(bold_file)
-    lowcut=int(timeseries_interval.split(',')[0])
-    highcut=int(timeseries_interval.split(',')[1])
-    bold_file=os.path.abspath('selected_timeseries.nii.gz')
-    nb.Nifti1Image(np.asarray(img.dataobj)[:,:,:,lowcut:highcut], img.affine, img.header).to_filename(bold_file)
-    return bold_file
-
-def regress(scan_info,bold_file, brain_mask_file, confounds_file, csf_mask, FD_file, conf_list, TR, lowpass, highpass, smoothing_filter, run_aroma, aroma_dim, apply_scrubbing, scrubbing_threshold, timeseries_interval, out_dir):
-    import os
     import pandas as pd
-    import numpy as np
-    import nibabel as nb
-    import nilearn.image
-    from conf_reg.utils import find_scans,scrubbing,exec_ICA_AROMA,csv2par
-
     confounds=pd.read_csv(confounds_file)
     keys=confounds.keys()
-    confounds_list=[]
+    names=[]
     for conf in conf_list:
         if conf=='mot_6':
-            motion_keys = ['mov1', 'mov2', 'mov3', 'rot1', 'rot2', 'rot3']
-            for mov in motion_keys:
-                confounds_list.append(np.asarray(confounds.get(mov)))
+            names+=['mov1', 'mov2', 'mov3', 'rot1', 'rot2', 'rot3']
         elif conf=='mot_24':
-            motion_keys = [s for s in keys if "rot" in s or "mov" in s]
-            for mov in motion_keys:
-                confounds_list.append(np.asarray(confounds.get(mov)))
+            names+=[s for s in keys if "rot" in s or "mov" in s]
         elif conf=='aCompCor':
             aCompCor_keys = [s for s in keys if "aCompCor" in s]
-            print('Applying aCompCor with '+len(aCompCor_keys)+' components.')
-            for aCompCor in aCompCor_keys:
-                confounds_list.append(np.asarray(confounds.get(aCompCor)))
-        elif conf=='mean_FD':
-            mean_FD=pd.read_csv(FD_file).get('Mean')
-            confounds_list.append(np.asarray(mean_FD))
+            print('Applying aCompCor with '+str(len(aCompCor_keys))+' components.')
+            names+=aCompCor_keys
+        else:
+            names.append(conf)
+    confounds_list=[]
+    for name in names:
+        if name=='mean_FD':
+            confounds_list.append(np.asarray(pd.read_csv(FD_file).get('Mean')))
         else:
-            confounds_list.append(np.asarray(confounds.get(conf)))
+            confounds_list.append(np.asarray(confounds.get(name)))
+    return names,confounds_list
+
+def nest_variants(variants):
+    '''
+    Orders the variants of a sweep so that each one follows the variant it extends, if any: among the variants
+    with the same temporal filter and scrubbing whose regressors are a subset of its regressors, the one with
+    the most regressors, which is set as variant['parent'] (None otherwise).
+    '''
+    def settings(variant):
+        return (variant['lowpass'], variant['highpass'], variant['filter_type'], bool(variant['apply_scrubbing']),
+            variant['scrubbing_threshold'] if variant['apply_scrubbing'] else None)
+    ordered=sorted(variants, key=lambda variant: len(set(variant['columns'])))
+    for i,variant in enumerate(ordered):
+        variant['parent']=None
+        for candidate in ordered[:i]:
+            if settings(candidate)==settings(variant) and set(candidate['columns'])<=set(variant['columns']):
+                if variant['parent'] is None or len(set(candidate['columns']))>len(set(variant['parent']['columns'])):
+                    variant['parent']=candidate
+    return ordered
+
+def scan_variants(scan_info, confounds_file, FD_file, interval, out_dir, output_store, output_format, defaults, sweep=None):
+    '''
+    Variants of the cleaning of a scan: the cleaning parameters in defaults, updated by each variant of the sweep
+    if provided, with their regressors and the paths of their outputs, in the subdirectory of out_dir named after
+    the variant with a sweep.
+    '''
+    import os
+    import numpy as np
+    from conf_reg.utils import confound_regressors
+    from conf_reg.cleaning import output_file
+    if sweep is None:
+        variants=[dict(defaults, name=None)]
+    else:
+        variants=[dict(defaults, **variant) for variant in sweep]
+    for variant in variants:
+        variant_dir=out_dir if variant['name'] is None else out_dir+'/'+variant['name']
+        os.makedirs(variant_dir, exist_ok=True)
+        variant['columns'],confounds_list=confound_regressors(confounds_file, FD_file, variant['conf_list'])
+        if len(confounds_list)>0:
+            variant['confounds']=np.transpose(np.asarray(confounds_list))[interval,:]
+        else:
+            variant['confounds']=None
+        #the cleaned timeseries are written as a 4D image and/or as a masked store of the in-mask voxels
+        cleaned_path=None
+        masked_store=None
+        if output_store in ['nifti', 'both']:
+            cleaned_path=output_file(variant_dir+'/'+scan_info+'_cleaned', output_format)
+        if output_store in ['masked', 'both']:
+            masked_store=variant_dir+'/'+scan_info+'_cleaned_masked'
+        frame_mask_file=variant_dir+'/'+scan_info+'_frame_mask.csv' if variant['apply_scrubbing'] else None
+        variant['outputs']={'cleaned':cleaned_path, 'masked_store':masked_store, 'frame_mask':frame_mask_file}
+        variant['store']=masked_store
+    return variants
+
+def restore_variant(variant, result_cache, memory_budget, gzip_level, n_threads):
+    '''
+    Restores the outputs of a variant of the cleaning from the result cache, or writes them from its cleaning
+    checkpoint, a masked store restored to variant['store']. Returns False if neither is in the cache.
+    '''
+    from conf_reg.cache import fetch_result,store_result,copy_output
+    from conf_reg.cleaning import block_size,masked_store_to_file,load_masked_store
+    outputs=variant['outputs']
+    if fetch_result(result_cache, variant['stages']['write'], outputs) is not None:
+        return True
+    if fetch_result(result_cache, variant['stages']['clean'], {'cleaned':variant['store'], 'frame_mask':outputs['frame_mask']}) is None:
+        return False
+    n_voxels=None
+    if memory_budget is not None:
+        n_voxels=block_size(memory_budget, load_masked_store(variant['store'])['timeseries'].shape[0], itemsize=8, copies=2)
+    if outputs['cleaned'] is not None:
+        masked_store_to_file(variant['store'], outputs['cleaned'], n_voxels=n_voxels, gzip_level=gzip_level, n_threads=n_threads)
+    if outputs['masked_store'] is not None and outputs['masked_store']!=variant['store']:
+        copy_output(variant['store'], outputs['masked_store'])
+    return True
+
+def regress(scan_info,bold_file, brain_mask_file, confounds_file, csf_mask, FD_file, conf_list, TR, lowpass, highpass, smoothing_filter, run_aroma, aroma_dim, apply_scrubbing, scrubbing_threshold, timeseries_interval, out_dir, memory_budget=None, filter_type='butterworth', n_threads=1, dtype='float64', gzip_index_dir=None, scratch_dir=None, scratch_budget=10, output_format='nii.gz', gzip_level=1, output_store='nifti', smoothing_within_mask=False, write_smoothed=False, result_cache=None, result_cache_size=50, sweep=None, aroma_seed=0):
+    import os
+    import shutil
+    import tempfile
+    import pandas as pd
+    import numpy as np
+    from conf_reg.utils import parse_interval,scan_variants,restore_variant,clean_scan
+    from conf_reg.cleaning import output_file,finalize_image
 
     '''
     what would be nice would be to have a print out of the variance explained for each regressor, to confirm it accounts for something
     '''
 
-    #including detrending, standardization
-    cleaning_input=nilearn.image.smooth_img(bold_file, smoothing_filter)
-    aroma_out=out_dir
+    interval=parse_interval(timeseries_interval)
+    #with a sweep (a list of variants of the cleaning parameters, see load_sweep_spec()), the scan is loaded, smoothed
+    #and denoised with ICA-AROMA once, and the outputs of each variant are written in its subdirectory of out_dir
+    defaults={'conf_list':conf_list, 'lowpass':lowpass, 'highpass':highpass, 'filter_type':filter_type, 'apply_scrubbing':apply_scrubbing, 'scrubbing_threshold':scrubbing_threshold}
+    variants=scan_variants(scan_info, confounds_file, FD_file, interval, out_dir, output_store, output_format, defaults, sweep)
+    aroma_out=out_dir+'/%s_aroma' % (scan_info) if run_aroma else out_dir
+    smooth_path=os.path.abspath(output_file(out_dir+'/%s_smoothed' % (scan_info), output_format)) if write_smoothed else None
+    shared={'aroma':aroma_out if run_aroma else None, 'smoothed':smooth_path}
+
+    results=[(variant['outputs']['cleaned'] if variant['outputs']['cleaned'] is not None else variant['outputs']['masked_store'], variant['outputs']['frame_mask'], variant['outputs']['masked_store']) for variant in variants]
+    if sweep is None:
+        cleaned_path,frame_mask_file,masked_store=results[0]
+    else:
+        cleaned_path,frame_mask_file,masked_store=[list(result) for result in zip(*results)]
+
+    if result_cache is None:
+        clean_scan(scan_info, bold_file, interval, brain_mask_file, variants, csf_mask, FD_file, confounds_file, TR, smoothing_filter, smoothing_within_mask,
+            run_aroma, aroma_dim, timeseries_interval, memory_budget, n_threads, dtype, gzip_index_dir, scratch_dir, scratch_budget, gzip_level, shared, aroma_seed=aroma_seed)
+        return cleaned_path, bold_file, aroma_out, frame_mask_file, masked_store
+
+    #each stage is cached under a key made of the key of the stage it depends on, the content of its own input
+    #files and its own parameters, so that changing a downstream parameter reuses the upstream checkpoints
+    from conf_reg.cache import result_key,fetch_result,store_result
+    start,stop,step=interval.indices(len(pd.read_csv(confounds_file)))
+    stages={}
+    stages['smooth']=result_key({'bold':bold_file, 'brain_mask':brain_mask_file},
+        {'stage':'smooth', 'smoothing_filter':smoothing_filter, 'smoothing_within_mask':smoothing_within_mask, 'interval':[start,stop]}, result_cache)
+    upstream=stages['smooth']
     if run_aroma:
-        aroma_out=out_dir+'/%s_aroma' % (scan_info)
-        smooth_path=os.path.abspath(out_dir+'/%s_smoothed.nii.gz' % (scan_info))
-        cleaning_input.to_filename(smooth_path)
-        cleaning_input=exec_ICA_AROMA(smooth_path, aroma_out, csv2par(confounds_file), brain_mask_file, csf_mask, TR, aroma_dim)
-    if len(confounds_list)>0:
-        confounds_array=np.transpose(np.asarray(confounds_list))
-        if not timeseries_interval=='all':
-            lowcut=int(timeseries_interval.split(',')[0])
-            highcut=int(timeseries_interval.split(',')[1])
-            confounds_array=confounds_array[lowcut:highcut,:]
-        cleaned = nilearn.image.clean_img(cleaning_input, detrend=True, standardize=True, low_pass=lowpass, high_pass=highpass, confounds=confounds_array, t_r=TR, mask_img=brain_mask_file)
+        stages['aroma']=result_key({'confounds':confounds_file, 'csf_mask':csf_mask}, {'stage':'aroma', 'smooth':stages['smooth'], 'interval':[start,stop], 'TR':TR, 'aroma_dim':aroma_dim, 'aroma_seed':aroma_seed}, result_cache)
+        upstream=stages['aroma']
+    for variant in variants:
+        variant['stages']={}
+        variant['stages']['clean']=result_key({'confounds':confounds_file, 'FD':FD_file if variant['apply_scrubbing'] or 'mean_FD' in variant['conf_list'] else None},
+            {'stage':'clean', 'upstream':upstream, 'conf_list':sorted(set(variant['conf_list'])), 'TR':TR, 'lowpass':variant['lowpass'], 'highpass':variant['highpass'],
+             'filter_type':variant['filter_type'], 'scrubbing_threshold':variant['scrubbing_threshold'] if variant['apply_scrubbing'] else None, 'dtype':dtype}, result_cache)
+        variant['stages']['write']=result_key({}, {'stage':'write', 'clean':variant['stages']['clean'], 'output_format':output_format, 'output_store':output_store}, result_cache)
+
+    work_dir=tempfile.mkdtemp(dir=os.getcwd())
+    try:
+        #the checkpoints of the smoothing and of the cleaning are an uncompressed smoothed image and masked stores
+        smoothed_file=os.path.join(work_dir, 'smoothed.nii')
+        for i,variant in enumerate(variants):
+            if variant['store'] is None:
+                variant['store']=os.path.join(work_dir, '%s_cleaned_masked' % (i))
+        #the variants are restored from their outputs, or written from their cleaning checkpoint, and the upstream
+        #stages are only run if a variant or one of their own outputs is missing
+        pending=[variant for variant in variants if not restore_variant(variant, result_cache, memory_budget, gzip_level, n_threads)]
+        aroma_restored=run_aroma and fetch_result(result_cache, stages['aroma'], {'aroma':aroma_out}) is not None
+        computed=[]
+        if len(pending)>0 or (run_aroma and not aroma_restored) or write_smoothed:
+            smooth_restored=fetch_result(result_cache, stages['smooth'], {'smoothed':smoothed_file}) is not None
+            if len(pending)==0 and not (run_aroma and not aroma_restored) and smooth_restored:
+                finalize_image(smoothed_file, smooth_path, gzip_level=gzip_level, n_threads=n_threads)
+            else:
+                computed=clean_scan(scan_info, bold_file, interval, brain_mask_file, pending, csf_mask, FD_file, confounds_file, TR, smoothing_filter, smoothing_within_mask,
+                    run_aroma, aroma_dim, timeseries_interval, memory_budget, n_threads, dtype, gzip_index_dir, scratch_dir, scratch_budget, gzip_level, shared,
+                    smoothed_file=smoothed_file, aroma_restored=aroma_restored, aroma_seed=aroma_seed)
+        checkpoints={'smooth':{'smoothed':smoothed_file}, 'aroma':{'aroma':shared['aroma']}}
+        for stage in computed:
+            store_result(result_cache, stages[stage], checkpoints[stage], result_cache_size)
+        for variant in pending:
+            store_result(result_cache, variant['stages']['clean'], {'cleaned':variant['store'], 'frame_mask':variant['outputs']['frame_mask']}, result_cache_size)
+        for variant in variants:
+            store_result(result_cache, variant['stages']['write'], variant['outputs'], result_cache_size)
+    finally:
+        shutil.rmtree(work_dir)
+    return cleaned_path, bold_file, aroma_out, frame_mask_file, masked_store
+
+def variant_designs(variants, n_timepoints, TR, FD_file, timeseries_interval, n_threads, dtype):
+    '''
+    Builds the cleaning design of each variant, as variant['design'], writing its scrubbing temporal mask, and returns
+    the variants ordered so that the variants extending another one (see nest_variants()) reuse its factorization.
+    '''
+    import pandas as pd
+    from conf_reg.utils import scrubbing_mask,nest_variants
+    from conf_reg.cleaning import CleaningDesign
+    variants=nest_variants(variants)
+    for variant in variants:
+        frame_mask=None
+        if variant['apply_scrubbing']:
+            frame_mask=scrubbing_mask(FD_file, variant['scrubbing_threshold'], timeseries_interval)
+            print('Scrubbing %s out of %s frames.' % (len(frame_mask)-frame_mask.sum(), len(frame_mask)))
+            pd.DataFrame({'frame_mask':frame_mask.astype(int)}).to_csv(variant['outputs']['frame_mask'], index=False)
+        parent=variant['parent']
+        if parent is None:
+            variant['design']=CleaningDesign(n_timepoints, TR, confounds=variant['confounds'], low_pass=variant['lowpass'], high_pass=variant['highpass'],
+                filter_type=variant['filter_type'], n_threads=n_threads, dtype=dtype, frame_mask=frame_mask)
+        else:
+            extra=[i for i,column in enumerate(variant['columns']) if column not in parent['columns']]
+            variant['design']=parent['design'].extend(variant['confounds'][:,extra] if len(extra)>0 else None)
+    return variants
+
+def denoised_timeseries(img, interval, brain_mask, smoothing_filter, smoothing_within_mask, aroma_stage, n_threads, dtype, gzip_level, shared, smoothed_file=None, out_data=None):
+    '''
+    Smooths the frames of img in the interval (unless img is the smoothed checkpoint smoothed_file), writes the smoothed
+    output and checkpoint if requested, and returns the time x voxel array of the in-mask voxels in dtype, denoised with
+    ICA-AROMA through aroma_stage (see clean_scan()) if provided. The array is written in out_data if provided, and img is returned
+    along with it as the reference image of the outputs.
+    '''
+    import os
+    import numpy as np
+    import nibabel as nb
+    from conf_reg.cleaning import mask_timeseries,write_image,smooth_image
+    smoothed_exists=smoothed_file is not None and os.path.isfile(smoothed_file)
+    if not interval==slice(None):
+        img=img.slicer[:,:,:,interval]
+    if smoothed_exists:
+        smoothed=img
+    else:
+        smoothed=smooth_image(img, brain_mask, smoothing_filter, within_mask=smoothing_within_mask, n_threads=n_threads, dtype=dtype)
+        if smoothed_file is not None:
+            nb.save(smoothed, smoothed_file)
+    if shared['smoothed'] is not None:
+        write_image(smoothed, shared['smoothed'], gzip_level=gzip_level, n_threads=n_threads)
+    data=mask_timeseries(np.asarray(smoothed.dataobj), brain_mask)
+    if out_data is None:
+        out_data=data.astype(dtype)
+    else:
+        out_data[:]=data
+    del data
+    if aroma_stage is not None:
+        denoise=aroma_stage(shared['smoothed'] if smoothed_file is None else smoothed_file, in_img=smoothed)
+        if denoise is not None:
+            out_data[:]=denoise(out_data)
+    return out_data,img
+
+def write_variant(variant, cleaned, brain_mask, img, gzip_level, n_threads):
+    '''
+    Writes the cleaned time x voxel array of a variant as its 4D image output and/or masked store.
+    '''
+    from conf_reg.cleaning import timeseries_to_img,write_image,write_masked_store
+    if variant['outputs']['cleaned'] is not None:
+        write_image(timeseries_to_img(cleaned, brain_mask, img), variant['outputs']['cleaned'], gzip_level=gzip_level, n_threads=n_threads)
+    if variant['store'] is not None:
+        write_masked_store(variant['store'], cleaned, brain_mask, img, frame_mask=variant['design'].frame_mask)
+
+def clean_scan(scan_info, bold_file, interval, brain_mask_file, variants, csf_mask, FD_file, confounds_file, TR, smoothing_filter, smoothing_within_mask,
+        run_aroma, aroma_dim, timeseries_interval, memory_budget, n_threads, dtype, gzip_index_dir, scratch_dir, scratch_budget, gzip_level, shared,
+        smoothed_file=None, aroma_restored=False, aroma_seed=0):
+    '''
+    Runs the stages of the cleaning of a scan for regress(): smoothing and ICA-AROMA, shared by the variants of the
+    cleaning parameters (see regress()), then scrubbing and cleaning of the timeseries with the design of each variant,
+    and writing of its outputs. The variants extending another one (see nest_variants()) reuse its factorization and
+    residuals. With smoothed_file, the smoothed image is read from this uncompressed checkpoint if it exists, and is
+    otherwise written there. With aroma_restored, the ICA-AROMA outputs were restored to shared['aroma'], and the
+    denoising is read from them. Returns the list of the upstream stages which were computed.
+    '''
+    import os
+    import numpy as np
+    import nibabel as nb
+    from conf_reg.utils import exec_ICA_AROMA,aroma_denoiser,csv2par,report_precision,variant_designs,denoised_timeseries,write_variant
+    from conf_reg.cleaning import load_image,load_mask,precision_check,FLOAT32_TOLERANCE,sweep_apply
+
+    computed=[]
+    smoothed_exists=smoothed_file is not None and os.path.isfile(smoothed_file)
+    if smoothed_file is not None and not smoothed_exists:
+        computed.append('smooth')
+    if run_aroma and not aroma_restored:
+        computed.append('aroma')
+
+    #the BOLD is loaded once, and the following steps operate on the time x voxel array of the in-mask voxels.
+    #The timeseries interval is only applied when reading the frames, without writing a selected timeseries.
+    #The smoothed checkpoint only holds the frames of the interval, which still applies to the motion parameters
+    if smoothed_exists:
+        img=nb.load(smoothed_file, mmap=True)
+        frames=slice(None)
+        smoothing_filter=None
     else:
-        cleaned = nilearn.image.clean_img(cleaning_input, detrend=True, standardize=True, low_pass=lowpass, high_pass=highpass, confounds=None, t_r=TR, mask_img=brain_mask_file)
-    if apply_scrubbing:
-        cleaned=scrubbing(cleaned, FD_file, scrubbing_threshold, timeseries_interval)
-    cleaned_path=out_dir+'/'+scan_info+'_cleaned.nii.gz'
-    cleaned.to_filename(cleaned_path)
-    return cleaned_path, bold_file, aroma_out
-
-def data_diagnosis(bold_file, cleaned_path, brain_mask_file, seed_list):
+        img=load_image(bold_file, index_dir=gzip_index_dir, scratch_dir=scratch_dir, scratch_budget=scratch_budget)
+        frames=interval
+    n_timepoints=len(range(img.shape[3])[frames])
+    brain_mask=load_mask(brain_mask_file)
+    #including detrending, standardization
+    variants=variant_designs(variants, n_timepoints, TR, FD_file, timeseries_interval, n_threads, dtype)
+    designs=[variant['design'] for variant in variants]
+
+    def aroma_stage(smooth_path, in_img=None):
+        if aroma_restored:
+            return aroma_denoiser(shared['aroma'])
+        return exec_ICA_AROMA(shared['aroma'], csv2par(confounds_file, interval), brain_mask_file, csf_mask, TR, aroma_dim, in_img=in_img, inFile=smooth_path, seed=aroma_seed)
+
+    if memory_budget is not None:
+        from conf_reg.utils import stream_regress
+        stream_regress(scan_info, img, frames, brain_mask, n_timepoints, np.dtype(dtype), variants, smoothing_filter, aroma_stage if run_aroma else None, memory_budget,
+            n_threads, gzip_level, smoothing_within_mask, shared['smoothed'], smoothed_file)
+        return computed
+
+    data,img=denoised_timeseries(img, frames, brain_mask, smoothing_filter, smoothing_within_mask, aroma_stage if run_aroma else None, n_threads, dtype,
+        gzip_level, shared, smoothed_file=smoothed_file)
+    if np.dtype(dtype)!=np.float64 and len(designs)>0:
+        report_precision(max(precision_check(data, design) for design in designs), FLOAT32_TOLERANCE)
+
+    for variant,cleaned in zip(variants, sweep_apply(designs, data)):
+        write_variant(variant, cleaned, brain_mask, img, gzip_level, n_threads)
+        del cleaned
+    return computed
+
+def stream_regress(scan_info, img, interval, brain_mask, n_timepoints, dtype, variants, smoothing_filter, aroma_stage, memory_budget, n_threads, gzip_level=1, smoothing_within_mask=False, smooth_path=None, smoothed_file=None):
+    '''
+    Out-of-core version of the cleaning in clean_scan(), keeping the memory use within memory_budget (in GB).
+    The frames are smoothed by chunks into a memory-mapped time x voxel array, which is then cleaned by
+    blocks of voxels with the design of each variant, and scattered into a memory-mapped output image (if the
+    variant has a cleaned output) and/or stored in the memory-mapped array of its masked store. The smoothed
+    frames are also written to an uncompressed image (smoothed_file if provided, otherwise in scratch) when
+    ICA-AROMA is run (with aroma_stage(smoothed image file), which returns the denoising applied block by block)
+    or when they are written to smooth_path. If smoothed_file exists, img is this smoothed image and
+    smoothing_filter is None.
+    '''
+    import os
+    import shutil
+    import tempfile
+    import numpy as np
+    from conf_reg.cleaning import block_size,nifti_memmap,finalize_image,smooth_to_timeseries,clean_blocks,create_masked_store
+    from conf_reg.utils import report_precision
+    from conf_reg.cleaning import precision_check,FLOAT32_TOLERANCE
+
+    n_voxels=int(brain_mask.sum())
+    designs=[variant['design'] for variant in variants]
+    scratch_dir=tempfile.mkdtemp(dir=os.getcwd())
+    try:
+        data=np.memmap(os.path.join(scratch_dir, 'timeseries.dat'), dtype=dtype, mode='w+', shape=(n_timepoints, n_voxels), order='F')
+        smoothed_array=None
+        smoothed_exists=smoothed_file is not None and os.path.isfile(smoothed_file)
+        if smoothed_file is None and (aroma_stage is not None or smooth_path is not None):
+            smoothed_file=os.path.join(scratch_dir, '%s_smoothed.nii' % (scan_info))
+        if smoothed_file is not None and not smoothed_exists:
+            smoothed_array=nifti_memmap(smoothed_file, img, img.shape[:3]+(n_timepoints,), dtype)
+        smooth_to_timeseries(img, brain_mask, smoothing_filter, block_size(memory_budget, int(np.prod(img.shape[:3])), itemsize=dtype.itemsize, copies=4), data, smoothed_array, interval=interval, within_mask=smoothing_within_mask, n_threads=n_threads, dtype=dtype)
+        if smoothed_array is not None:
+            smoothed_array.flush()
+        del smoothed_array
+        if dtype!=np.float64 and len(designs)>0:
+            report_precision(max(precision_check(data, design) for design in designs), FLOAT32_TOLERANCE)
+
+        denoise=None
+        if aroma_stage is not None:
+            denoise=aroma_stage(smoothed_file)
+        if smooth_path is not None:
+            #the smoothed image is copied when it is kept as a checkpoint
+            if not smoothed_file.startswith(scratch_dir):
+                shutil.copyfile(smoothed_file, os.path.join(scratch_dir, 'smoothed_copy.nii'))
+                smoothed_file=os.path.join(scratch_dir, 'smoothed_copy.nii')
+            finalize_image(smoothed_file, smooth_path, gzip_level=gzip_level, n_threads=n_threads)
+
+        out_arrays=[]
+        out_timeseries=[]
+        for i,variant in enumerate(variants):
+            out_array=None
+            timeseries=None
+            if variant['outputs']['cleaned'] is not None:
+                out_array=nifti_memmap(os.path.join(scratch_dir, '%s_%s_cleaned.nii' % (scan_info, i)), img, img.shape[:3]+(variant['design'].n_frames,), dtype)
+            if variant['store'] is not None:
+                timeseries=create_masked_store(variant['store'], brain_mask, img, variant['design'].n_frames, dtype, frame_mask=variant['design'].frame_mask)
+            out_arrays.append(out_array)
+            out_timeseries.append(timeseries)
+        #the blocks hold the data, the intermediate arrays shared between the designs and the cleaned block of each design
+        clean_blocks(data, brain_mask, designs, block_size(memory_budget, n_timepoints, itemsize=dtype.itemsize, copies=5+len(designs)), out_arrays, denoise=denoise, out_timeseries=out_timeseries)
+        for array in out_arrays+out_timeseries:
+            if array is not None:
+                array.flush()
+        del out_arrays, out_timeseries, data
+        for i,variant in enumerate(variants):
+            if variant['outputs']['cleaned'] is not None:
+                finalize_image(os.path.join(scratch_dir, '%s_%s_cleaned.nii' % (scan_info, i)), variant['outputs']['cleaned'], gzip_level=gzip_level, n_threads=n_threads)
+    finally:
+        shutil.rmtree(scratch_dir)
+
+def commonspace_batches(scan_list, catalog, timeseries_interval, memory_budget, dtype='float64'):
+    '''
+    Groups the scans with the same image shape and brain mask, as in commonspace, into the batches cleaned together
+    by regress_batch(). The batches are sized so that the time x voxel arrays of their scans, with the intermediate
+    arrays of the cleaning (BATCH_COPIES in total), and the 4D image of the scan being smoothed fit within
+    memory_budget (in GB).
+    '''
+    import hashlib
+    import numpy as np
+    import nibabel as nb
+    from conf_reg.utils import find_scans,parse_interval
+    from conf_reg.cleaning import load_mask
+    groups={}
+    for scan_info in scan_list:
+        bold_file,brain_mask_file,confounds_file,csf_mask,FD_file=find_scans(scan_info, catalog)
+        mask=load_mask(brain_mask_file)
+        key=(nb.load(bold_file).shape, hashlib.sha1(np.packbits(mask).tobytes()).hexdigest(), int(mask.sum()))
+        groups.setdefault(key, []).append(scan_info)
+    interval=parse_interval(timeseries_interval)
+    batches=[]
+    for (shape,mask_key,n_voxels),scans in sorted(groups.items()):
+        n_timepoints=len(range(shape[3])[interval])
+        scan_bytes=n_timepoints*n_voxels*np.dtype(dtype).itemsize*BATCH_COPIES
+        #the image being smoothed is held as loaded, smoothed and masked in dtype
+        image_bytes=int(np.prod(shape[:3]))*n_timepoints*np.dtype(dtype).itemsize*3
+        size=max(1, int((memory_budget*1e9-image_bytes)//scan_bytes))
+        batches+=[scans[start:start+size] for start in range(0, len(scans), size)]
+    return batches
+
+def regress_batch(batch_index, batches, catalog, conf_list, TR, lowpass, highpass, smoothing_filter, run_aroma, aroma_dim, apply_scrubbing, scrubbing_threshold, timeseries_interval, out_dir, memory_budget=None, filter_type='butterworth', n_threads=1, dtype='float64', gzip_index_dir=None, scratch_dir=None, scratch_budget=10, output_format='nii.gz', gzip_level=1, output_store='nifti', smoothing_within_mask=False, write_smoothed=False, result_cache=None, result_cache_size=50, sweep=None, aroma_seed=0):
+    '''
+    Cleaning of batches[batch_index], a batch of scans with the same number of frames and brain mask (see
+    commonspace_batches()). Each scan is smoothed and denoised with ICA-AROMA in turn into its columns of a
+    time x (scans x voxels) array, which is then cleaned at once by cleaning.batch_apply(). A batch of a single
+    scan, when two would not fit within memory_budget, is cleaned by regress() instead. Returns the lists of the
+    outputs of regress() for the scans of the batch, and the list of their brain masks.
+    '''
+    import os
+    import numpy as np
+    from conf_reg.utils import find_scans,regress,parse_interval,scan_variants,variant_designs,denoised_timeseries,write_variant,exec_ICA_AROMA,csv2par,report_precision
+    from conf_reg.cleaning import load_image,load_mask,output_file,batch_apply,precision_check,FLOAT32_TOLERANCE
+
+    batch=batches[batch_index]
+    files=[find_scans(scan_info, catalog) for scan_info in batch]
+    if len(batch)==1:
+        outputs=regress(batch[0], *files[0], conf_list, TR, lowpass, highpass, smoothing_filter, run_aroma, aroma_dim, apply_scrubbing, scrubbing_threshold,
+            timeseries_interval, out_dir, memory_budget=memory_budget, filter_type=filter_type, n_threads=n_threads, dtype=dtype, gzip_index_dir=gzip_index_dir,
+            scratch_dir=scratch_dir, scratch_budget=scratch_budget, output_format=output_format, gzip_level=gzip_level, output_store=output_store,
+            smoothing_within_mask=smoothing_within_mask, write_smoothed=write_smoothed, result_cache=result_cache, result_cache_size=result_cache_size, sweep=sweep, aroma_seed=aroma_seed)
+        return tuple([output] for output in outputs)+([files[0][1]],)
+    if sweep is not None or result_cache is not None:
+        raise ValueError('The batches of scans are cleaned without sweep nor result cache.')
+
+    interval=parse_interval(timeseries_interval)
+    brain_mask=load_mask(files[0][1])
+    n_voxels=int(brain_mask.sum())
+    defaults={'conf_list':conf_list, 'lowpass':lowpass, 'highpass':highpass, 'filter_type':filter_type, 'apply_scrubbing':apply_scrubbing, 'scrubbing_threshold':scrubbing_threshold}
+    data=None
+    variants=[]
+    imgs=[]
+    aroma_outs=[]
+    for k,(scan_info,(bold_file,brain_mask_file,confounds_file,csf_mask,FD_file)) in enumerate(zip(batch, files)):
+        if not np.array_equal(load_mask(brain_mask_file), brain_mask):
+            raise ValueError('The brain mask of %s differs from the other scans of the batch.' % (scan_info))
+        img=load_image(bold_file, index_dir=gzip_index_dir, scratch_dir=scratch_dir, scratch_budget=scratch_budget)
+        n_timepoints=len(range(img.shape[3])[interval])
+        if data is None:
+            data=np.empty((n_timepoints, len(batch)*n_voxels), dtype=dtype)
+        variant=scan_variants(scan_info, confounds_file, FD_file, interval, out_dir, output_store, output_format, defaults)[0]
+        variants+=variant_designs([variant], n_timepoints, TR, FD_file, timeseries_interval, n_threads, dtype)
+        aroma_out=out_dir+'/%s_aroma' % (scan_info) if run_aroma else out_dir
+        shared={'aroma':aroma_out if run_aroma else None,
+            'smoothed':os.path.abspath(output_file(out_dir+'/%s_smoothed' % (scan_info), output_format)) if write_smoothed else None}
+
+        def aroma_stage(smooth_path, in_img=None):
+            return exec_ICA_AROMA(shared['aroma'], csv2par(confounds_file, interval), brain_mask_file, csf_mask, TR, aroma_dim, in_img=in_img, inFile=smooth_path, seed=aroma_seed)
+
+        #the scans are smoothed and denoised one at a time, in place in their columns
+        block,img=denoised_timeseries(img, interval, brain_mask, smoothing_filter, smoothing_within_mask, aroma_stage if run_aroma else None, n_threads, dtype,
+            gzip_level, shared, out_data=data[:,k*n_voxels:(k+1)*n_voxels])
+        if np.dtype(dtype)!=np.float64:
+            report_precision(precision_check(block, variants[-1]['design']), FLOAT32_TOLERANCE)
+        imgs.append(img)
+        aroma_outs.append(aroma_out)
+
+    cleaned=batch_apply([variant['design'] for variant in variants], data)
+    del data
+    for variant,block,img in zip(variants, cleaned, imgs):
+        write_variant(variant, block, brain_mask, img, gzip_level, n_threads)
+    del cleaned
+    cleaned_paths=[variant['outputs']['cleaned'] if variant['outputs']['cleaned'] is not None else variant['outputs']['masked_store'] for variant in variants]
+    return cleaned_paths, [scan_files[0] for scan_files in files], aroma_outs, [variant['outputs']['frame_mask'] for variant in variants], [variant['outputs']['masked_store'] for variant in variants], [scan_files[1] for scan_files in files]
+
+def data_diagnosis(bold_file, cleaned_path, brain_mask_file, seed_list, timeseries_interval='all', gzip_index_dir=None, scratch_dir=None, scratch_budget=10, output_format='nii.gz', gzip_level=1, n_threads=1, result_cache=None, result_cache_size=50):
     import os
     import nibabel as nb
     import numpy as np
+    from conf_reg.utils import parse_interval
+    from conf_reg.cleaning import load_image,output_file,write_image,masked_store_to_img
     mel_out=os.path.abspath('melodic.ica/')
+    tSNR_file=os.path.abspath(output_file('tSNR', output_format))
+    corr_map_list=[os.path.abspath(output_file(os.path.basename(seed).split('.nii')[0]+'_corr_map', output_format)) for seed in seed_list]
+    outputs={'melodic':mel_out, 'tSNR':tSNR_file}
+    outputs.update({'corr_map_%i' % (i):corr_map_file for i,corr_map_file in enumerate(corr_map_list)})
+    if result_cache is not None:
+        from conf_reg.cache import result_key,fetch_result
+        input_files={'bold':bold_file, 'cleaned':cleaned_path, 'brain_mask':brain_mask_file}
+        input_files.update({'seed_%i' % (i):seed for i,seed in enumerate(seed_list)})
+        key=result_key(input_files, {'diagnosis':True, 'timeseries_interval':timeseries_interval, 'output_format':output_format}, result_cache)
+        if fetch_result(result_cache, key, outputs) is not None:
+            return mel_out, tSNR_file, corr_map_list
+
+    if os.path.isdir(cleaned_path):
+        #a masked store is reconstructed as an uncompressed 4D image for MELODIC
+        masked_store=cleaned_path
+        cleaned_path=os.path.abspath('cleaned.nii')
+        masked_store_to_img(masked_store).to_filename(cleaned_path)
+    #the cleaned timeseries are loaded once for all diagnosis steps, and read from the scratch copy if available
+    cleaned_img=load_image(cleaned_path, scratch_dir=scratch_dir, scratch_budget=scratch_budget)
     os.mkdir(mel_out)
-    command='melodic -i %s -o %s -m %s --report' % (cleaned_path, mel_out, brain_mask_file)
+    command='melodic -i %s -o %s -m %s --report' % (cleaned_img.get_filename(), mel_out, brain_mask_file)
     os.system(command)
-    img=nb.load(bold_file)
-    array=np.asarray(img.dataobj)
+    img=load_image(bold_file, index_dir=gzip_index_dir, scratch_dir=scratch_dir, scratch_budget=scratch_budget)
+    array=np.asarray(img.dataobj[:,:,:,parse_interval(timeseries_interval)])
     mean=array.mean(axis=3)
     std=array.std(axis=3)
     tSNR=np.divide(mean, std)
-    tSNR_file=os.path.abspath('tSNR.nii.gz')
-    nb.Nifti1Image(tSNR, img.affine, img.header).to_filename(tSNR_file)
+    header=img.header.copy()
+    header.set_data_dtype(np.float32)
+    write_image(nb.Nifti1Image(tSNR, img.affine, header), tSNR_file, gzip_level=gzip_level, n_threads=n_threads)
+    del array
 
-    def seed_based_FC(bold_file, brain_mask, seed):
+    def seed_based_FC(cleaned_file, sub_timeseries, mask_img, seed):
         import os
         import nibabel as nb
         import numpy as np
         from nilearn.input_data import NiftiMasker
-        img=nb.load(bold_file)
-        array=np.asarray(img.dataobj)
-
+        from conf_reg.cleaning import output_file,write_image
         masker = NiftiMasker(mask_img=nb.load(seed), standardize=False, verbose=0)
-        voxel_seed_timeseries = masker.fit_transform(bold_file) #extract the voxel timeseries within the mask
+        voxel_seed_timeseries = masker.fit_transform(cleaned_file) #extract the voxel timeseries within the mask
         seed_timeseries=np.mean(voxel_seed_timeseries, axis=1) #take the mean ROI timeseries
 
-        mask_array=np.asarray(nb.load(brain_mask).dataobj)
-        mask_vector=mask_array.reshape(-1)
-        mask_indices=(mask_vector==True)
-
-        timeseries_array=np.asarray(nb.load(bold_file).dataobj)
-        sub_timeseries=np.zeros([mask_indices.sum(),timeseries_array.shape[3]])
-        for t in range(timeseries_array.shape[3]):
-            sub_timeseries[:,t]=(timeseries_array[:,:,:,t].reshape(-1))[mask_indices]
-
         #return a correlation between each row of X with y
         def vcorrcoef(X,y):
             Xm = np.reshape(np.mean(X,axis=1),(X.shape[0],1))
@@ -203,16 +774,25 @@ def data_diagnosis(bold_file, cleaned_path, brain_mask_file, seed_list):
             return r
         corrs=vcorrcoef(sub_timeseries,seed_timeseries)
 
-        mask_vector[mask_indices]=corrs
-        corr_map=mask_vector.reshape(mask_array.shape)
-        corr_map_file=os.path.abspath(os.path.basename(seed).split('.nii')[0]+'_corr_map.nii.gz')
-        nb.Nifti1Image(corr_map, nb.load(brain_mask).affine, nb.load(brain_mask).header).to_filename(corr_map_file)
+        brain_mask=np.asarray(mask_img.dataobj)>0
+        corr_map=np.zeros(brain_mask.shape, dtype=np.float32)
+        corr_map[brain_mask]=corrs
+        corr_map_file=os.path.abspath(output_file(os.path.basename(seed).split('.nii')[0]+'_corr_map', output_format))
+        header=mask_img.header.copy()
+        header.set_data_dtype(np.float32)
+        write_image(nb.Nifti1Image(corr_map, mask_img.affine, header), corr_map_file, gzip_level=gzip_level, n_threads=n_threads)
         return corr_map_file
 
     corr_map_list=[]
+    if len(seed_list)>0:
+        mask_img=nb.load(brain_mask_file)
+        sub_timeseries=np.asanyarray(cleaned_img.dataobj)[np.asarray(mask_img.dataobj)>0]
     for seed in seed_list:
         os.system('antsApplyTransforms -i %s -r %s -o %s -n GenericLabel' % (seed, brain_mask_file, os.path.abspath(os.path.basename(seed))))
-        corr_map_file=seed_based_FC(cleaned_path, brain_mask_file, seed)
+        corr_map_file=seed_based_FC(cleaned_img.get_filename(), sub_timeseries, mask_img, seed)
         corr_map_list.append(corr_map_file)
 
+    if result_cache is not None:
+        from conf_reg.cache import store_result
+        store_result(result_cache, key, outputs, result_cache_size)
     return mel_out, tSNR_file, corr_map_list